@@ -0,0 +1,173 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from typing import Any, Optional
+
+from websockets.exceptions import ConnectionClosed
+
+import codec
+import metrics
+from config_parser import Config
+from job_executor import JobExecutor
+from job_processor import JobProcessor
+from network import NetworkOptions
+from send_scheduler import CONTROL
+
+
+class AsyncJobProcessor(JobProcessor):
+    """Asyncio engine of the job processor
+    Cluster send/recv, task pulling and job handling all run as tasks
+    on one event loop and talk through bounded asyncio.Queue
+    The outbound SendScheduler is thread-safe, so DManager threads put relays on it directly
+    """
+    _loop: Optional[asyncio.AbstractEventLoop]
+
+    def __init__(self, config: Config):
+        super().__init__(config)
+        self._loop = None
+
+    async def monitor(self) -> None:
+        while not self.closed:
+            await asyncio.sleep(60)
+            self.logger.info(f"OPEN: {str(self.bili_ws.rooms)} | LIVE: {len(self.bili_ws.lived)} | "
+                             f"LIMIT: {self.WS_LIMIT}")
+            self.logger.info(self.format_send_stats(self.send_queue.stats()))
+            self.logger.info(self.pull.stats())
+            if self.tracer.enabled:
+                self.logger.info(self.tracer.format_summary())
+
+    async def pull_task(self) -> None:
+        """Pull a task from websockets server
+        Send string "DDDhttp" to server
+        The pull controller decides by job backlog and in-flight count
+        """
+        pull = self.pull
+        while not self.closed:
+            for _ in range(pull.should_pull(self.task_queue.qsize(), self.executor.inflight)):
+                # 控制队列已满时本轮不再拉取
+                if not self.send_queue.put_nowait((CONTROL, "DDDhttp")):
+                    break
+                pull.on_pull()
+            await asyncio.sleep(pull.delay)
+
+    async def receive_task(self) -> None:
+        """Receive a task from websockets server
+        Check the type and put it into queue
+        """
+        queue_put = self.task_queue.put
+        recv = self.recv_queue.get
+        while not self.closed:
+            received, receive_text = await recv()
+            text: Any = codec.loads(receive_text)
+            if "empty" in text:
+                self.pull.on_reply(empty=True)
+                self.logger.debug("No job, wait.")
+            elif "data" in text:
+                task_type = text["data"].get("type", None)
+                if task_type == "http":
+                    self.pull.on_reply(empty=False)
+                    await queue_put((received, text["key"], text["data"]["url"]))
+                    metrics.JOBS_RECEIVED.inc()
+                    self.logger.info(f"Job {text['key']} received.")
+                elif task_type == "query":
+                    result = text["data"].get("result", None)
+                    if not self.picker.on_reply(text.get("key")):
+                        self.logger.debug(f"Unmatched query reply {text.get('key')}")
+                    if self.bili_ws.started and self.bili_ws.free:
+                        # watch 可能要等管理线程的事件循环启动, 不能阻塞当前事件循环
+                        await self._loop.run_in_executor(None, self.bili_ws.watch, result)
+
+    async def handle(self) -> None:
+        """Handle http task and send back to server
+        """
+        await self.executor.run(self.task_queue.get, self.send_queue.put_async)
+
+    async def pull_ws(self) -> None:
+        """Pull live room ws tasks from server.
+        Keep pickRoom queries outstanding up to the free capacity
+        Wake up as soon as WSLive reports a closed room
+        """
+        freed = asyncio.Event()
+
+        def listener() -> None:
+            self._loop.call_soon_threadsafe(freed.set)
+
+        self.bili_ws.add_listener(listener)
+        try:
+            while not self.closed:
+                free = self.bili_ws.free
+                for query in self.picker.queries(free, self.bili_ws.connecting):
+                    self.send_queue.put_nowait((CONTROL, query))
+                try:
+                    await asyncio.wait_for(freed.wait(), self.picker.delay(free))
+                except asyncio.TimeoutError:
+                    pass
+                freed.clear()
+        finally:
+            self.bili_ws.remove_listener(listener)
+
+    async def ws_send(self) -> None:
+        send = codec.text_sender(self.websockets.send)
+        while not self.closed:
+            _, msg, trace = await self.send_queue.get_async()
+            await send(msg)
+            if trace is not None:
+                trace.sent = time.time_ns()
+                self.tracer.finish(trace)
+            metrics.CLUSTER_SENT.inc()
+            self.logger.debug("Send %s", msg)
+
+    async def ws_recv(self) -> None:
+        while not self.closed:
+            receive_msg = await self.websockets.recv()
+            await self.recv_queue.put((time.time_ns(), receive_msg))
+            metrics.CLUSTER_RECEIVED.inc()
+            self.logger.debug("Receive %s", receive_msg)
+
+    async def startup(self, websockets) -> None:
+        """Run every stage as a task until one of them fails
+        The failure cancels the others and is raised to the connector
+        """
+        self.closed = False
+        self.websockets = websockets
+        self._loop = asyncio.get_running_loop()
+        self.task_queue = asyncio.Queue(maxsize=self.config.task_queue_size)
+        self.recv_queue = asyncio.Queue(maxsize=self.config.recv_queue_size)
+        self.bili_ws.set_queue(self.send_queue)
+        self.pull.reset()
+        self.picker.reset()
+        self.executor = JobExecutor(self.MAX_INFLIGHT, self.NETWORK, self.logger, self.pull, self.tracer, self.cache,
+                                    self.config.max_response_size << 10, self.limiter, self.signer,
+                                    self.identities, NetworkOptions.from_config(self.config))
+        stages = {
+            "pull_task": self.pull_task, "receive": self.receive_task, "handle": self.handle,
+            "pull_ws": self.pull_ws, "ws_send": self.ws_send, "ws_recv": self.ws_recv, "monitor": self.monitor,
+        }
+        lag = asyncio.ensure_future(metrics.watch_loop_lag("asyncio"))
+        self.tasks = [asyncio.ensure_future(stages[t_type]()) for t_type in self.task_types]
+        # 只有开启 relay 时才启动弹幕事件循环线程
+        if "pull_ws" in self.task_types and not self.bili_ws.is_alive():
+            self.bili_ws.start()
+        try:
+            done, pending = await asyncio.wait(self.tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            lag.cancel()
+            [t.cancel() for t in self.tasks]
+            await asyncio.gather(*self.tasks, return_exceptions=True)
+        for t in done:
+            if not t.cancelled() and t.exception() is not None:
+                if isinstance(t.exception(), ConnectionClosed):
+                    raise t.exception()
+                raise ConnectionClosed(None, None) from t.exception()
+
+    def close(self) -> None:
+        """Stop pulling task from server
+        Cancel every running stage on the event loop
+        """
+        self.closed = True
+        if self.executor is not None:
+            self.executor.close()
+        if self._loop is not None and not self._loop.is_closed():
+            [self._loop.call_soon_threadsafe(t.cancel) for t in self.tasks]
+        self.tracer.close()
@@ -0,0 +1,65 @@
+"""Compare the json backends of codec.py on recorded payloads
+
+Usage: python benchmarks/codec_bench.py [-n NUMBER] [--json]
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import codec  # noqa: E402
+
+PAYLOADS = os.path.join(os.path.dirname(os.path.realpath(__file__)), "payloads.json")
+
+
+def _legacy() -> codec.Backend:
+    """The code path before codec.py: str from json.dumps, encoded by websockets"""
+
+    def dumps(obj):
+        return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+    return codec.Backend("legacy", dumps, lambda data: json.loads(str(data, "utf-8")), (ValueError,))
+
+
+def run(number: int) -> list[dict]:
+    with open(PAYLOADS, encoding="utf-8") as f:
+        payloads: dict = json.load(f)
+    results = []
+    for backend in [_legacy()] + codec.available():
+        for name, obj in payloads.items():
+            data = backend.dumps(obj)
+            assert json.loads(data) == obj
+            dumps = min(timeit.repeat(lambda: backend.dumps(obj), number=number, repeat=5)) / number
+            loads = min(timeit.repeat(lambda: backend.loads(data), number=number, repeat=5)) / number
+            results.append({
+                "backend": backend.name,
+                "payload": name,
+                "bytes": len(data),
+                "dumps_us": round(dumps * 1e6, 3),
+                "loads_us": round(loads * 1e6, 3),
+            })
+    return results
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--number", type=int, default=2000, help="calls per timing run")
+    parser.add_argument("--json", action="store_true", help="print results as json")
+    args = parser.parse_args()
+    results = run(args.number)
+    if args.json:
+        print(json.dumps({"selected": codec.BACKEND.name, "results": results}, indent=1))
+        return
+    print(f"selected backend: {codec.BACKEND.name}")
+    print(f"{'backend':<10}{'payload':<16}{'bytes':>8}{'dumps us':>12}{'loads us':>12}")
+    for r in results:
+        print(f"{r['backend']:<10}{r['payload']:<16}{r['bytes']:>8}{r['dumps_us']:>12.3f}{r['loads_us']:>12.3f}")
+
+
+if __name__ == "__main__":
+    main()
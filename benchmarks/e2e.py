@@ -0,0 +1,283 @@
+"""Offline end-to-end benchmark of a DD@Home node
+
+Runs a fake cluster, a fake HTTP API and a fake danmaku server on localhost,
+starts a real node (Connector/JobProcessor/WSLive) against them in a child
+process and reports throughput, latency, CPU and memory as json
+
+Usage: python benchmarks/e2e.py [--duration 30] [--rooms 20] [--engine thread] [--out results.jsonl]
+"""
+from __future__ import annotations
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Optional
+
+import brotli
+import websockets
+from aiohttp import web
+
+ROOT = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+sys.path.insert(0, ROOT)
+
+import dm_packet  # noqa: E402
+
+
+def percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def pick(q: float) -> float:
+        return round(values[min(int(q * len(values)), len(values) - 1)], 3)
+
+    return {"p50": pick(.5), "p90": pick(.9), "p99": pick(.99), "max": round(values[-1], 3)}
+
+
+class Bench:
+    """State of the three fake servers, shared by their handlers"""
+
+    def __init__(self, args: argparse.Namespace) -> None:
+        self.args = args
+        self.body = json.dumps({"code": 0, "data": "x" * args.payload}, separators=(",", ":"))
+        self.api_url = ""
+        self.measuring = False
+        self.next_key = 0
+        self.next_room = 0
+        self.next_mid = 0
+        self.dispatched: dict[str, float] = {}
+        self.jobs = 0
+        self.job_latency: list[float] = []
+        self.relays = 0
+        self.relay_latency: list[float] = []
+        self.connections = 0
+
+    # 假 cluster: 分发 http 任务和 pickRoom 结果, 统计任务结果与弹幕转发
+    async def cluster(self, ws) -> None:
+        try:
+            await self._cluster(ws)
+        except websockets.ConnectionClosed:
+            pass
+
+    async def _cluster(self, ws) -> None:
+        async for msg in ws:
+            now = time.monotonic()
+            if msg == "DDDhttp":
+                key = str(self.next_key)
+                self.next_key += 1
+                self.dispatched[key] = now
+                await ws.send(json.dumps({"key": key, "data": {"type": "http", "url": f"{self.api_url}/api?k={key}"}}))
+                continue
+            data = json.loads(msg)
+            if "query" in data:
+                if self.next_room < self.args.rooms:
+                    self.next_room += 1
+                    await ws.send(json.dumps({"key": data["key"], "data": {"type": "query", "result": self.next_room}}))
+            elif "relay" in data:
+                if self.measuring:
+                    self.relays += 1
+                    relay = data["relay"]
+                    if relay["e"] == "DANMU_MSG":
+                        self.relay_latency.append(time.time() * 1000 - relay["data"]["timestamp"])
+            elif (sent := self.dispatched.pop(data.get("key"), None)) is not None and self.measuring:
+                self.jobs += 1
+                self.job_latency.append((now - sent) * 1000)
+
+    # 假 API: 按设定延迟返回固定大小的内容
+    async def api(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.args.api_latency / 1000)
+        return web.Response(text=self.body, content_type="application/json")
+
+    async def danmu_info(self, request: web.Request) -> web.Response:
+        return web.json_response({"code": 0, "data": {"token": "bench"}})
+
+    # 假弹幕服务器: 认证后按设定速率发送 protover 3 的 brotli 批量消息
+    async def danmaku(self, ws) -> None:
+        reader = None
+        batch = max(int(self.args.msg_rate / self.args.frame_rate), 1)
+        try:
+            await ws.recv()
+            self.connections += 1
+            await ws.send(dm_packet.encode(dm_packet.OP_AUTH_REPLY, b'{"code":0}'))
+            await ws.send(dm_packet.encode(dm_packet.OP_HEARTBEAT_REPLY, struct.pack(">I", 1)))
+            reader = asyncio.ensure_future(self._drain(ws))
+            while True:
+                await asyncio.sleep(1 / self.args.frame_rate)
+                await ws.send(dm_packet.encode(dm_packet.OP_MESSAGE, brotli.compress(self._batch(batch)),
+                                               ver=dm_packet.PROTO_BROTLI))
+        except websockets.ConnectionClosed:
+            pass
+        finally:
+            if reader is not None:
+                reader.cancel()
+
+    def _batch(self, size: int) -> bytes:
+        timestamp = int(time.time() * 1000)
+        packets = []
+        for _ in range(size):
+            self.next_mid += 1
+            body = json.dumps({"cmd": "DANMU_MSG", "info": [
+                [0, 1, 25, 16777215, timestamp, 0, 0, "", 0, 0], "bench", [self.next_mid, "bench"],
+            ]}, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+            packets.append(dm_packet.encode(dm_packet.OP_MESSAGE, body, ver=dm_packet.PROTO_JSON))
+        return b"".join(packets)
+
+    @staticmethod
+    async def _drain(ws) -> None:
+        try:
+            async for _ in ws:
+                pass
+        except websockets.ConnectionClosed:
+            pass
+
+
+def write_config(directory: str, args: argparse.Namespace) -> None:
+    with open(os.path.join(directory, "config.ini"), "w", encoding="utf-8") as f:
+        f.write("\n".join([
+            "[Settings]",
+            "uuid = BENCH",
+            "name = bench",
+            f"ws_limit = {args.rooms}",
+            f"relay = {'on' if args.rooms else 'off'}",
+            f"connect_rate = {max(args.rooms, 1)}",
+            f"max_inflight = {args.max_inflight}",
+            f"engine = {args.engine}",
+            # 本地模拟的 API 不限速, 否则测到的是限速器而不是节点
+            "rate_limit = 0",
+            "[Network]",
+            "ip = ipv4",
+            "",
+        ]))
+
+
+def proc_cpu(pid: int) -> Optional[float]:
+    """CPU seconds used by pid so far, None where /proc is not available"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def proc_rss(pid: int) -> Optional[int]:
+    """Resident memory of pid in KB"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+async def run(args: argparse.Namespace) -> dict:
+    bench = Bench(args)
+    cluster = await websockets.serve(bench.cluster, "127.0.0.1", 0)
+    danmaku = await websockets.serve(bench.danmaku, "127.0.0.1", 0)
+    app = web.Application()
+    app.router.add_get("/api", bench.api)
+    app.router.add_get("/getDanmuInfo", bench.danmu_info)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    api_port = runner.addresses[0][1]
+    bench.api_url = f"http://127.0.0.1:{api_port}"
+    urls = [
+        f"ws://127.0.0.1:{cluster.sockets[0].getsockname()[1]}/",
+        f"{bench.api_url}/getDanmuInfo",
+        f"ws://127.0.0.1:{danmaku.sockets[0].getsockname()[1]}/sub",
+    ]
+    with tempfile.TemporaryDirectory() as directory:
+        write_config(directory, args)
+        output = None if args.verbose else subprocess.DEVNULL
+        node = subprocess.Popen([sys.executable, os.path.realpath(__file__), "--node", *urls],
+                                cwd=directory, stdout=output, stderr=output)
+        try:
+            await asyncio.sleep(args.warmup)
+            bench.measuring = True
+            start, cpu_start = time.monotonic(), proc_cpu(node.pid)
+            await asyncio.sleep(args.duration)
+            bench.measuring = False
+            elapsed, cpu_end = time.monotonic() - start, proc_cpu(node.pid)
+            rss = proc_rss(node.pid)
+        finally:
+            node.kill()
+            _, _, usage = os.wait4(node.pid, 0)
+    cluster.close()
+    danmaku.close()
+    await runner.cleanup()
+    if rss is None:
+        rss = usage.ru_maxrss // (1024 if sys.platform == "darwin" else 1)
+    cpu = cpu_end - cpu_start if cpu_start is not None and cpu_end is not None else None
+    return {
+        "commit": commit(),
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "params": {k: v for k, v in vars(args).items() if k not in ("node", "out", "verbose")},
+        "jobs_per_s": round(bench.jobs / elapsed, 2),
+        "job_latency_ms": percentiles(bench.job_latency),
+        "relays_per_s": round(bench.relays / elapsed, 2),
+        "relay_latency_ms": percentiles(bench.relay_latency),
+        "rooms_connected": bench.connections,
+        "cpu_percent": round(cpu / elapsed * 100, 1) if cpu is not None else None,
+        "cpu_total_s": round(usage.ru_utime + usage.ru_stime, 2),
+        "rss_kb": rss,
+        "rss_per_room_kb": round(rss / bench.connections, 1) if bench.connections else None,
+    }
+
+
+def node(cluster_url: str, danmu_info_url: str, wss_url: str) -> None:
+    """Child process: the real node pointed at the fake servers"""
+    from connector import Connector
+    from dm import BiliDM
+
+    Connector.CLUSTER_URL = cluster_url
+    BiliDM.DANMU_INFO_URL = danmu_info_url
+    BiliDM.WSS_URL = wss_url
+    Connector().connect()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--duration", type=float, default=30, help="measured seconds")
+    parser.add_argument("--warmup", type=float, default=5, help="seconds before measuring")
+    parser.add_argument("--rooms", type=int, default=20, help="live rooms handed out by the cluster")
+    parser.add_argument("--msg-rate", type=float, default=50, help="danmaku messages per second per room")
+    parser.add_argument("--frame-rate", type=float, default=5, help="danmaku frames per second per room")
+    parser.add_argument("--api-latency", type=float, default=50, help="API response delay in ms")
+    parser.add_argument("--payload", type=int, default=2048, help="API response size in bytes")
+    parser.add_argument("--max-inflight", type=int, default=8)
+    parser.add_argument("--engine", choices=("thread", "asyncio"), default="thread")
+    parser.add_argument("--out", help="append the result as one json line to this file")
+    parser.add_argument("--verbose", action="store_true", help="show the node's log output")
+    parser.add_argument("--node", nargs=3, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.node:
+        node(*args.node)
+        return
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=1))
+    if args.out:
+        with open(args.out, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result) + "\n")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,102 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+
+class TTLCache:
+    """LRU cache whose entries expire ttl seconds after they are set
+    Thread-safe, shared by the event loops of different threads
+    """
+    _data: OrderedDict[Hashable, tuple[float, Any]]
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            if item[0] <= time.monotonic():
+                self._discard(key)
+                return default
+            self._data.move_to_end(key)
+            return item[1]
+
+    def set(self, key: Hashable, value: Any, ttl: Optional[float] = None) -> None:
+        expires = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._insert(key, expires, value)
+
+    def add(self, key: Hashable, value: Any = True) -> bool:
+        """Set key only if it is missing or expired, return True if it was set"""
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                return False
+            self._insert(key, now + self.ttl, value)
+            return True
+
+    def pop(self, key: Hashable, default: Optional[Any] = None) -> Any:
+        with self._lock:
+            item = self._discard(key)
+        return default if item is None else item[1]
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, self) is not self
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    # 以下方法均在持有锁时调用
+    def _insert(self, key: Hashable, expires: float, value: Any) -> None:
+        self._discard(key)
+        self._data[key] = (expires, value)
+        self._shrink()
+
+    def _discard(self, key: Hashable) -> Optional[tuple[float, Any]]:
+        return self._data.pop(key, None)
+
+    def _shrink(self) -> None:
+        while len(self._data) > self.maxsize:
+            self._discard(next(iter(self._data)))
+
+
+class SizedTTLCache(TTLCache):
+    """TTLCache that also caps the total size of its values
+    Least recently used entries are evicted first, a value larger than
+    maxbytes is not cached at all
+    """
+
+    def __init__(self, maxbytes: int, ttl: float, sizeof: Callable[[Any], int] = len,
+                 maxsize: int = 1 << 20) -> None:
+        super().__init__(maxsize, ttl)
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.nbytes = 0
+
+    def _insert(self, key: Hashable, expires: float, value: Any) -> None:
+        self._discard(key)
+        size = self.sizeof(value)
+        if size > self.maxbytes:
+            return
+        self.nbytes += size
+        super()._insert(key, expires, value)
+
+    def _discard(self, key: Hashable) -> Optional[tuple[float, Any]]:
+        item = super()._discard(key)
+        if item is not None:
+            self.nbytes -= self.sizeof(item[1])
+        return item
+
+    def _shrink(self) -> None:
+        super()._shrink()
+        while self.nbytes > self.maxbytes and self._data:
+            self._discard(next(iter(self._data)))
@@ -0,0 +1,98 @@
+from __future__ import annotations
+
+import inspect
+import json
+import os
+from typing import Any, Callable, NamedTuple, Union
+
+Data = Union[bytes, bytearray, memoryview, str]
+
+
+class Backend(NamedTuple):
+    """dumps returns compact UTF-8 json bytes, non-ASCII is not escaped
+    loads accepts str or any bytes-like object
+    """
+    name: str
+    dumps: Callable[[Any], bytes]
+    loads: Callable[[Data], Any]
+    errors: tuple[type[Exception], ...]
+
+
+def _orjson() -> Backend:
+    import orjson
+
+    return Backend("orjson", orjson.dumps, orjson.loads, (orjson.JSONDecodeError,))
+
+
+def _msgspec() -> Backend:
+    import msgspec
+
+    encoder = msgspec.json.Encoder()
+    decoder = msgspec.json.Decoder()
+    return Backend("msgspec", encoder.encode, decoder.decode, (msgspec.DecodeError,))
+
+
+def _json() -> Backend:
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(",", ":"))
+
+    def dumps(obj: Any) -> bytes:
+        return encoder.encode(obj).encode("utf-8")
+
+    def loads(data: Data) -> Any:
+        if isinstance(data, memoryview):
+            data = data.tobytes()
+        return json.loads(data)
+
+    return Backend("json", dumps, loads, (ValueError,))
+
+
+# 按顺序使用第一个已安装的库, 可用环境变量 DD_JSON 指定
+BACKENDS: dict[str, Callable[[], Backend]] = {"orjson": _orjson, "msgspec": _msgspec, "json": _json}
+
+
+def load_backend(name: str) -> Backend:
+    return BACKENDS[name]()
+
+
+def available() -> list[Backend]:
+    backends = []
+    for name in BACKENDS:
+        try:
+            backends.append(load_backend(name))
+        except ImportError:
+            continue
+    return backends
+
+
+def _select() -> Backend:
+    if (name := os.environ.get("DD_JSON")) in BACKENDS:
+        try:
+            return load_backend(name)
+        except ImportError:
+            pass
+    return available()[0]
+
+
+BACKEND: Backend = _select()
+dumps = BACKEND.dumps
+loads = BACKEND.loads
+DecodeError: tuple[type[Exception], ...] = BACKEND.errors + (UnicodeDecodeError,)
+
+
+def text_sender(send: Callable[..., Any]) -> Callable[[Data], Any]:
+    """Wrap a websockets send method so bytes from dumps go out as text frames
+    Newer websockets take text=True and skip the decode, older ones need str
+    """
+    try:
+        takes_text = "text" in inspect.signature(send).parameters
+    except (TypeError, ValueError):
+        takes_text = False
+    if takes_text:
+        def send_text(data: Data) -> Any:
+            return send(data, text=isinstance(data, (bytes, bytearray, memoryview)) or None)
+    else:
+        def send_text(data: Data) -> Any:
+            if isinstance(data, (bytes, bytearray, memoryview)):
+                data = str(data, "utf-8")
+            return send(data)
+    return send_text
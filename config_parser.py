@@ -1,17 +1,201 @@
 from __future__ import annotations
 
 import configparser
+import ipaddress
 import os
-from typing import NoReturn
+import time
+from dataclasses import dataclass, fields
+from socket import AF_INET, AF_INET6
+from threading import Thread
+from typing import Any, Callable, NoReturn, Optional
+from uuid import uuid1
 
 from logger import Logger
 
 
+def _positive(value: str) -> int:
+    value = int(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+
+def _non_negative(value: str) -> int:
+    value = int(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def _positive_float(value: str) -> float:
+    value = float(value)
+    if value <= 0:
+        raise ValueError(value)
+    return value
+
+
+def _non_negative_float(value: str) -> float:
+    value = float(value)
+    if value < 0:
+        raise ValueError(value)
+    return value
+
+
+def _choice(*choices: str) -> Callable[[str], str]:
+    def parse(value: str) -> str:
+        if value not in choices:
+            raise ValueError(value)
+        return value
+
+    return parse
+
+
+def _switch(value: str) -> bool:
+    if value not in ("on", "off"):
+        raise ValueError(value)
+    return value == "on"
+
+
+def _per_class(parse: Callable[[str], Any]) -> Callable[[str], tuple]:
+    """Comma separated values for job,control,relay messages"""
+
+    def parse_all(value: str) -> tuple:
+        values = tuple(parse(v.strip()) for v in value.split(","))
+        if len(values) != 3:
+            raise ValueError(value)
+        return values
+
+    return parse_all
+
+
+def _addresses(value: str) -> tuple[str, ...]:
+    """Comma separated IP addresses or IPv6 prefixes, empty for none"""
+    values = tuple(v.strip() for v in value.split(",") if v.strip())
+    for v in values:
+        if "/" in v:
+            # 前缀内至少要有一个可随机选取的主机地址
+            net = ipaddress.ip_network(v, strict=False)
+            if net.version != 6 or net.prefixlen > 126:
+                raise ValueError(v)
+        else:
+            ipaddress.ip_address(v)
+    return values
+
+
+_weights = _per_class(_positive)
+
+
+def _text(value: Any) -> str:
+    if isinstance(value, bool):
+        return "on" if value else "off"
+    if isinstance(value, tuple):
+        return ",".join(map(str, value))
+    return str(value)
+
+
+@dataclass(frozen=True)
+class Config:
+    """Validated snapshot of config.ini"""
+    uuid: str
+    name: str
+    interval: int
+    max_size: int
+    ws_limit: int
+    relay: bool
+    connect_rate: float
+    heartbeat_window: float
+    dedupe_ttl: float
+    dedupe_size: int
+    max_inflight: int
+    ws_loops: int
+    engine: str
+    send_policy: str
+    send_weights: tuple[int, ...]
+    pull_mode: str
+    task_queue_size: int
+    recv_queue_size: int
+    send_queue_size: tuple[int, ...]
+    send_drop_policy: tuple[str, ...]
+    metrics_port: int
+    trace_size: int
+    trace_file: str
+    cache_ttl: float
+    cache_size: int
+    max_response_size: int
+    rate_limit: float
+    risk_cooldown: float
+    identity_pool: int
+    ip: str
+    limit_per_host: int
+    keepalive_timeout: float
+    dns_ttl: int
+    happy_eyeballs_delay: float
+    source_addresses: tuple[str, ...]
+    prefix_addresses: int
+
+    # 修改后无需重启即可生效的设置
+    HOT_OPTIONS = ("interval", "max_size", "ws_limit", "ip")
+
+    @property
+    def network(self) -> int:
+        if self.ip == "ipv4":
+            return AF_INET
+        elif self.ip == "ipv6":
+            return AF_INET6
+        return 0
+
+    def changed(self, other: Config) -> list[str]:
+        return [f.name for f in fields(self) if getattr(self, f.name) != getattr(other, f.name)]
+
+
+# (section, option, default, parse), default 也会经过 parse
+OPTIONS: tuple[tuple[str, str, str, Callable[[str], Any]], ...] = (
+    ("Settings", "uuid", "", lambda v: v or str(uuid1()).upper() + "infoc"),
+    ("Settings", "name", "DD", lambda v: v or "DD"),
+    ("Settings", "interval", "1000", _positive),
+    ("Settings", "max_size", "10", _positive),
+    ("Settings", "ws_limit", "1000", _non_negative),
+    ("Settings", "relay", "off", _switch),
+    ("Settings", "connect_rate", "10.0", _positive_float),
+    ("Settings", "heartbeat_window", "30.0", _non_negative_float),
+    ("Settings", "dedupe_ttl", "600.0", _positive_float),
+    ("Settings", "dedupe_size", "100000", _positive),
+    ("Settings", "max_inflight", "8", _positive),
+    ("Settings", "ws_loops", "0", _non_negative),
+    ("Settings", "engine", "thread", _choice("thread", "asyncio")),
+    ("Settings", "send_policy", "weighted", _choice("weighted", "strict")),
+    ("Settings", "send_weights", "8,4,1", _weights),
+    ("Settings", "pull_mode", "adaptive", _choice("adaptive", "fixed")),
+    ("Settings", "task_queue_size", "100", _positive),
+    ("Settings", "recv_queue_size", "1000", _positive),
+    ("Settings", "send_queue_size", "1000,100,10000", _per_class(_positive)),
+    ("Settings", "send_drop_policy", "block,drop_newest,block",
+     _per_class(_choice("block", "drop_oldest", "drop_newest"))),
+    ("Settings", "metrics_port", "0", _non_negative),
+    ("Settings", "trace_size", "1000", _non_negative),
+    ("Settings", "trace_file", "", lambda v: v),
+    ("Settings", "cache_ttl", "0.0", _non_negative_float),
+    ("Settings", "cache_size", "16", _positive),
+    ("Settings", "max_response_size", "4096", _positive),
+    ("Settings", "rate_limit", "10.0", _non_negative_float),
+    ("Settings", "risk_cooldown", "60.0", _positive_float),
+    ("Settings", "identity_pool", "16", _positive),
+    ("Network", "ip", "both", _choice("ipv4", "ipv6", "both")),
+    ("Network", "limit_per_host", "0", _non_negative),
+    ("Network", "keepalive_timeout", "15.0", _non_negative_float),
+    ("Network", "dns_ttl", "10", _non_negative),
+    ("Network", "happy_eyeballs_delay", "0.25", _non_negative_float),
+    ("Network", "source_addresses", "", _addresses),
+    ("Network", "prefix_addresses", "4", _positive),
+)
+
+
 class ConfigParser:
     logger = Logger(logger_name="config")
 
     def __init__(self) -> None:
         self.parser = configparser.ConfigParser(allow_no_value=True)
+        self.mtime: float = 0.0
         if not os.path.exists("config.ini"):
             self.init_config()
         self.get_parser()
@@ -24,6 +208,35 @@ class ConfigParser:
             self.parser.read("config.ini", encoding="gbk")
         return self.parser
 
+    def load(self) -> Config:
+        """Read config.ini once and validate every option
+        Invalid or missing values fall back to the default, the file is
+        only written when one of them had to be fixed
+        """
+        self.mtime = self.get_mtime()
+        parser = self.get_parser()
+        values: dict[str, Any] = {}
+        fixed: dict[tuple[str, str], str] = {}
+        for section, option, default, parse in OPTIONS:
+            raw: Optional[str] = parser.get(section, option, fallback=None)
+            try:
+                value = parse(raw.strip() if raw else default)
+            except ValueError:
+                value = parse(default)
+            if raw is None or raw.strip() != _text(value):
+                fixed[(section, option)] = _text(value)
+            values[option] = value
+        if fixed:
+            self.save_many(fixed)
+        return Config(**values)
+
+    @staticmethod
+    def get_mtime() -> float:
+        try:
+            return os.stat("config.ini").st_mtime
+        except OSError:
+            return 0.0
+
     def init_config(self) -> NoReturn:
         self.parser.clear()
         try:
@@ -36,16 +249,76 @@ class ConfigParser:
                 "uuid": "",
                 "; 昵称 | 选填, 会显示在统计中": None,
                 "name": "DD",
-                "; 请求间隔时间 (毫秒), 包括拉取任务间隔和请求API间隔 | 选填, 默认1000": None,
+                "; 请求间隔时间 (毫秒), 固定拉取模式下的拉取任务间隔 | 选填, 默认1000": None,
                 "interval": 1000,
-                "; 最大队列长度, 超出将不再获取新任务 | 选填, 默认10": None,
+                "; 最大任务积压数, 超出将不再获取新任务 | 选填, 默认10": None,
                 "max_size": 10,
                 "; 直播服务器连接数, 同时转发多少直播间 | 选填, 默认1000": None,
                 "ws_limit": 1000,
+                "; 弹幕转发, 开启(on)/关闭(off) | 选填, 默认off": None,
+                "relay": "off",
+                "; 每秒最多新建多少个直播服务器连接 | 选填, 默认10": None,
+                "connect_rate": 10,
+                "; 人气值合并窗口 (秒), 窗口内只转发最新的人气值 | 选填, 0为不合并, 默认30": None,
+                "heartbeat_window": 30,
+                "; 弹幕去重记录保留时间 (秒), 重连后不重复转发 | 选填, 默认600": None,
+                "dedupe_ttl": 600,
+                "; 弹幕去重记录条数上限 | 选填, 默认100000": None,
+                "dedupe_size": 100000,
+                "; 最大并发请求数, 同时处理多少个任务 | 选填, 默认8": None,
+                "max_inflight": 8,
+                "; 直播服务器事件循环数, 按负载分配直播间 | 选填, 0为CPU核心数, 默认0": None,
+                "ws_loops": 0,
+                "; 运行引擎, 多线程(thread)/单事件循环(asyncio) | 选填, 默认thread": None,
+                "engine": "thread",
+                "; 上传队列调度, 按权重轮转(weighted)/严格优先级(strict) | 选填, 默认weighted": None,
+                "send_policy": "weighted",
+                "; 上传权重, 依次为任务结果,任务拉取,弹幕转发 | 选填, 默认8,4,1": None,
+                "send_weights": "8,4,1",
+                "; 任务拉取模式, 根据延迟和空闲率自适应(adaptive)/按固定间隔(fixed) | 选填, 默认adaptive": None,
+                "pull_mode": "adaptive",
+                "; 待处理任务队列容量, 满时暂停接收 | 选填, 默认100": None,
+                "task_queue_size": 100,
+                "; 服务器消息队列容量, 满时暂停读取 | 选填, 默认1000": None,
+                "recv_queue_size": 1000,
+                "; 上传队列容量, 依次为任务结果,任务拉取,弹幕转发 | 选填, 默认1000,100,10000": None,
+                "send_queue_size": "1000,100,10000",
+                "; 上传队列满时的处理, 阻塞(block)/丢弃最旧(drop_oldest)/丢弃最新(drop_newest), 依次同上 | 选填, 默认block,drop_newest,block": None,
+                "send_drop_policy": "block,drop_newest,block",
+                "; Prometheus 监控端口, 仅监听127.0.0.1 | 选填, 0为关闭, 默认0": None,
+                "metrics_port": 0,
+                "; 保留最近多少个任务的耗时记录, 每分钟输出排队/网络/上传等待统计 | 选填, 0为关闭, 默认1000": None,
+                "trace_size": 1000,
+                "; 任务耗时记录写入的文件, 每行一个json | 选填, 留空为不写入": None,
+                "trace_file": "",
+                "; 相同请求的结果缓存时间 (秒), 同时到达的相同请求总是只请求一次 | 选填, 0为不缓存, 默认0": None,
+                "cache_ttl": 0,
+                "; 结果缓存大小上限 (MB), 超出时淘汰最久未用的结果 | 选填, 默认16": None,
+                "cache_size": 16,
+                "; 单个任务响应大小上限 (KB), 超出视为失败 | 选填, 默认4096": None,
+                "max_response_size": 4096,
+                "; 每个B站域名每秒最多请求数, 触发风控后自动降速 | 选填, 0为不限, 默认10": None,
+                "rate_limit": 10,
+                "; 触发风控后暂停请求的时间 (秒), 连续触发时翻倍 | 选填, 默认60": None,
+                "risk_cooldown": 60,
+                "; 轮流使用的 buvid3 身份数, 被风控的身份会被替换 | 选填, 默认16": None,
+                "identity_pool": 16,
             },
             "Network": {
                 "; IP协议, ipv4/ipv6/同时使用(both) | 通常无需设置, 默认both": None,
                 "ip": "both",
+                "; 每个域名最多同时打开的连接数 | 选填, 0为不限, 默认0": None,
+                "limit_per_host": 0,
+                "; 空闲连接保持时间 (秒) | 选填, 默认15": None,
+                "keepalive_timeout": 15,
+                "; DNS 解析结果缓存时间 (秒) | 选填, 0为不缓存, 默认10": None,
+                "dns_ttl": 10,
+                "; 同时有IPv4/IPv6地址时, 等待前一个地址多久后尝试下一个 (秒) | 选填, 0为依次尝试, 默认0.25": None,
+                "happy_eyeballs_delay": 0.25,
+                "; 轮流绑定的本机源地址或IPv6前缀, 逗号分隔, 前缀需已路由到本机 | 选填, 留空为系统默认": None,
+                "source_addresses": "",
+                "; 每个IPv6前缀随机生成的源地址数 | 选填, 默认4": None,
+                "prefix_addresses": 4,
             }
         })
         self.parser.write(open("config.ini", "w", encoding="utf-8"))
@@ -60,14 +333,46 @@ class ConfigParser:
         return self.parser.has_section(section)
 
     def save(self, section, option, content) -> None:
-        self.parser.clear()
-        try:
-            self.parser.read("config.ini", encoding="utf-8")
-        except UnicodeDecodeError:
-            self.parser.read("config.ini", encoding="gbk")
-        if not self.has_section(section):
-            self.parser[section] = {}
-        self.parser[section][option] = content
+        self.save_many({(section, option): content})
+
+    def save_many(self, contents: dict[tuple[str, str], str]) -> None:
+        self.get_parser()
+        for (section, option), content in contents.items():
+            if not self.has_section(section):
+                self.parser[section] = {}
+            self.parser[section][option] = content
         with open("config.ini", "w", encoding="utf-8") as f:
             self.parser.write(f)
+        self.mtime = self.get_mtime()
+
+
+class ConfigWatcher(Thread):
+    """Reload config.ini when its mtime changes
+    The new snapshot is passed to listener
+    """
+    CHECK_INTERVAL: float = 5.0
+
+    def __init__(self, parser: ConfigParser, config: Config, listener: Callable[[Config], None]) -> None:
+        super().__init__(name="ConfigWatcher", daemon=True)
+        self.parser = parser
+        self.config = config
+        self.listener = listener
+        self.closed = False
+
+    def run(self) -> None:
+        while not self.closed:
+            time.sleep(self.CHECK_INTERVAL)
+            if self.parser.get_mtime() == self.parser.mtime:
+                continue
+            config = self.parser.load()
+            changed = config.changed(self.config)
+            if not changed:
+                continue
+            self.parser.logger.info(f"Reload config.ini: {', '.join(changed)}")
+            if cold := [name for name in changed if name not in Config.HOT_OPTIONS]:
+                self.parser.logger.warning(f"重启后生效: {', '.join(cold)}")
+            self.config = config
+            self.listener(config)
 
+    def close(self) -> None:
+        self.closed = True
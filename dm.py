@@ -1,59 +1,143 @@
 from __future__ import annotations
 
 import asyncio
-import json
 import time
 import traceback
 from asyncio import TimeoutError
-from uuid import uuid1
+from typing import Callable, Optional
 
 import aiohttp
-import brotli
 import websockets
 from aiohttp.client_exceptions import ClientError
 from async_timeout import timeout
 
+import codec
+import dm_packet
+import metrics
+from cache import TTLCache
+from identity import IdentityPool
 from logger import Logger
+from rate_limit import HostLimiter, RateLimited
+from send_scheduler import RELAY
+
+
+_HANDLERS: dict[str, Callable[[BiliDM, dict], str]] = {}
+
+
+def handles(*cmds: str):
+    """Register a BiliDM method as the handler of the given cmds
+    The handler sends its relay message with BiliDM.relay
+    """
+    def wrapper(func):
+        for cmd in cmds:
+            _HANDLERS[cmd] = func
+        return func
+
+    return wrapper
 
 
 class BiliDM:
-    def __init__(self, room_id, loop: asyncio.AbstractEventLoop) -> None:
+    # cmd -> 处理函数, DANMU_MSG:4:0:2:2:2:0 之类的 cmd 按冒号前的部分查找
+    HANDLERS = _HANDLERS
+    # 弹幕服务器 token 缓存, 短时间内重连同一直播间时不再请求 getDanmuInfo
+    TOKENS: TTLCache = TTLCache(maxsize=4096, ttl=120)
+    logger = Logger(logger_name="live-ws", level=Logger.INFO)
+    # 已转发消息的 token, 跨重连和直播间重启去重
+    RELAYED: TTLCache = TTLCache(maxsize=100000, ttl=600)
+    # 人气值合并窗口 (秒), 窗口内只转发最新值, 0为不合并
+    HEARTBEAT_WINDOW: float = 30.0
+    # 转发队列满时每个 ws 帧最多等待的时间 (秒), 超时后帧内剩余消息直接丢弃
+    RELAY_TIMEOUT: float = 5.0
+    DANMU_INFO_URL: str = "https://api.live.bilibili.com/xlive/web-room/v1/index/getDanmuInfo"
+    WSS_URL: str = "wss://broadcastlv.chat.bilibili.com/sub"
+    # 与任务请求共用的按域名限速器
+    LIMITER: HostLimiter = HostLimiter(0)
+    # 与任务请求共用的 buvid3 身份池
+    IDENTITIES: IdentityPool = IdentityPool(1)
+    # 带 data 的转发事件, 以及整条消息都固定的直播状态事件
+    DATA_EVENTS: tuple[str, ...] = ("DANMU_MSG", "SEND_GIFT", "GUARD_BUY", "heartbeat")
+    STATUS_EVENTS: tuple[str, ...] = ("LIVE", "PREPARING", "ROUND")
+
+    def __init__(self, room_id, loop: asyncio.AbstractEventLoop, session: aiohttp.ClientSession) -> None:
         self._loop = loop
+        self.session = session
         self.send_queue = None
         self.bili_ws = None
         self.room_id = str(room_id)
-        self.logger = Logger(logger_name="live-ws", level=Logger.INFO)
-        self.wss_url = "wss://broadcastlv.chat.bilibili.com/sub"
+        self.wss_url = self.WSS_URL
         self.closed = False
+        # 收到的数据包数, 由 DManager 定期清零并折算为 msg_rate
+        self.messages = 0
+        # 已转发的消息数, 用于统计每个直播间的转发速率
+        self.relayed = 0
+        self.msg_rate = 0.0
+        self.connected = False
+        # 第一次连上弹幕服务器时调用, 由 DManager 设置
+        self.on_connected = None
+        self._attention = None
+        self._attention_pending = False
+        self.identity = None
+        # 当前 ws 帧的转发截止时间, 帧内所有消息共用
+        self._relay_deadline = 0.0
+        self._build_templates()
+
+    @classmethod
+    def configure(cls, heartbeat_window: float, dedupe_ttl: float, dedupe_size: int,
+                  limiter: Optional[HostLimiter] = None, identities: Optional[IdentityPool] = None) -> None:
+        cls.HEARTBEAT_WINDOW = heartbeat_window
+        cls.RELAYED = TTLCache(maxsize=dedupe_size, ttl=dedupe_ttl)
+        if limiter is not None:
+            cls.LIMITER = limiter
+        if identities is not None:
+            cls.IDENTITIES = identities
 
     def set_queue(self, send_queue) -> None:
         self.send_queue = send_queue
 
     async def get_key(self):
-        url = "https://api.live.bilibili.com/xlive/web-room/v1/index/getDanmuInfo"
+        if (token := self.TOKENS.get(self.room_id)) is not None:
+            return token
+        url = self.DANMU_INFO_URL
         payload = {
             "id": self.room_id,
             "type": 0,
         }
         headers = {
-            "cookie": f"_uuid=; rpdid=; buvid3={str(uuid1()).upper() + 'infoc'}",
+            "cookie": self.identity.cookie,
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                           "Chrome/102.0.0.0 Safari/537.36",
         }
         try:
             async with timeout(10):
-                async with aiohttp.request("GET", url, params=payload, headers=headers) as resp:
+                host = await self.LIMITER.acquire(url, 5)
+                async with self.session.get(url, params=payload, headers=headers) as resp:
                     # self.wss_url = self.wss_url + resp["data"]["host_list"][0]["host"] + "/sub"
-                    resp = json.loads(await resp.text(encoding="utf-8"))
-                    return resp["data"]["token"]
-        except (TimeoutError, OSError, ClientError):
+                    body = await resp.read()
+                    risky = self.LIMITER.is_risky(resp.status, body)
+                    # 只有 code 被风控时换掉这个身份, 大部分身份都被风控才暂停整个域名
+                    if risky and not self.LIMITER.is_risky(resp.status):
+                        # 已被其他请求换掉的身份同样只算这个身份失败
+                        self.IDENTITIES.retire(self.identity)
+                        if not self.IDENTITIES.storming:
+                            raise RateLimited(host, 0.0)
+                    if (cooldown := self.LIMITER.on_response(host, risky)) is not None:
+                        self.logger.warning(f"{host} 触发风控, 暂停请求 {cooldown:.0f}s")
+                    if risky:
+                        raise RateLimited(host, cooldown or 0.0)
+                    resp = codec.loads(body)
+                    token = resp["data"]["token"]
+                    self.TOKENS.set(self.room_id, token)
+                    return token
+        except (TimeoutError, OSError, ClientError, RateLimited):
             self.closed = True
 
     async def startup(self):
+        # 获取 token 和连接弹幕服务器使用同一个身份
+        self.identity = self.IDENTITIES.get()
         key = await self.get_key()
         if self.closed:
             return
-        payload = json.dumps(
+        payload = codec.dumps(
             {
                 "uid": 2,
                 "roomid": int(self.room_id),
@@ -61,17 +145,12 @@ class BiliDM:
                 "platform": "web",
                 "type": 2,
                 "key": key
-            },
-            separators=(",", ":")
+            }
         )
-        header_op = "001000010000000700000001"
-        header_len = ("0" * (8 - len(hex(len(payload) + 16)[2:])) + hex(len(payload) + 16)[2:]) if len(
-            hex(len(payload) + 16)[2:]) <= 8 else ...
-        header = header_len + header_op + \
-                 bytes(str(payload), encoding="utf-8").hex()
+        auth = dm_packet.encode(dm_packet.OP_AUTH, payload)
         headers = {
             "accept-language": "zh-CN",
-            "cookie": f"_uuid=; rpdid=; buvid3={str(uuid1()).upper() + 'infoc'}",
+            "cookie": self.identity.cookie,
             "origin": "https://live.bilibili.com",
             "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) "
                           "Chrome/102.0.0.0 Safari/537.36",
@@ -79,7 +158,14 @@ class BiliDM:
         async for self.bili_ws in websockets.connect(self.wss_url,
                                                      extra_headers=headers,
                                                      open_timeout=None):
-            await self.bili_ws.send(bytes.fromhex(header))
+            if self.closed:
+                await self.bili_ws.close()
+                break
+            await self.bili_ws.send(auth)
+            if not self.connected:
+                self.connected = True
+                if self.on_connected is not None:
+                    self.on_connected()
             self.logger.debug(
                 "[{room_id}]  Connected to danmaku server.".format(room_id=self.room_id))
             tasks = [asyncio.create_task(self.heart_beat(self.bili_ws)),
@@ -90,6 +176,7 @@ class BiliDM:
             except websockets.ConnectionClosed:
                 [task.cancel() for task in tasks]
                 if not self.closed:
+                    metrics.RECONNECTS.labels("danmaku").inc()
                     self.logger.debug(
                         "[{room_id}]  Reconnecting to danmaku server.".format(room_id=self.room_id))
                     continue
@@ -98,157 +185,163 @@ class BiliDM:
                 pass
 
     async def heart_beat(self, ws):
-        # [object Object]
-        hb = "0000001f0010000100000002000000015b6f626a656374204f626a6563745d"
         while not self.closed:
             await asyncio.sleep(60)
-            await ws.send(bytes.fromhex(hb))
-            self.logger.debug(
-                "[{room_id}][HEARTBEAT]  Send HeartBeat.".format(room_id=self.room_id))
+            await ws.send(dm_packet.HEARTBEAT)
+            self.logger.debug("[%s][HEARTBEAT]  Send HeartBeat.", self.room_id)
 
     async def receive_dm(self, ws):
         while not self.closed:
+            # 转发队列满时先不读取, 让压力传回直播服务器连接
+            await self.send_queue.wait_space(RELAY)
             receive_text = await ws.recv()
             if receive_text:
                 await self._loop.run_in_executor(None, self.process_dm, receive_text)
             await asyncio.sleep(0.1)
 
-    @staticmethod
-    def _dumps(data):
-        return json.dumps(data, ensure_ascii=False, separators=(",", ":"))
+    def relay(self, msg, block: bool = True, token: Optional[str] = None) -> bool:
+        """Queue msg for the cluster, return False if it was dropped
+        All messages of one ws frame wait at most RELAY_TIMEOUT in total,
+        heartbeats never wait since they are flushed on the event loop
+        token is only marked as relayed once msg is queued
+        """
+        wait = self._relay_deadline - time.monotonic()
+        if not self.send_queue.put((RELAY, msg), block=block and wait > 0, timeout=wait):
+            return False
+        if token is not None:
+            self.RELAYED.set(token, True)
+        self.relayed += 1
+        self.logger.debug(msg)
+        return True
 
-    def process_dm(self, data, is_decompressed=False):
-        # 获取数据包的长度，版本和操作类型
-        packet_len = int(data[:4].hex(), 16)
-        ver = int(data[6:8].hex(), 16)
-        op = int(data[8:12].hex(), 16)
+    def is_relayed(self, token: str) -> bool:
+        return token in self.RELAYED
 
-        # 有的时候可能会两个数据包连在一起发过来，所以利用前面的数据包长度判断，
-        if len(data) > packet_len:
-            self.process_dm(data[packet_len:])
-            data = data[:packet_len]
+    def on_attention(self, attention: int) -> None:
+        """Relay the first popularity value at once, then only the latest one per window"""
+        self._attention = attention
+        if self.HEARTBEAT_WINDOW <= 0:
+            self._flush_attention()
+        elif not self._attention_pending:
+            self._attention_pending = True
+            self._flush_attention()
+            self._loop.call_soon_threadsafe(self._loop.call_later, self.HEARTBEAT_WINDOW, self._end_window)
 
-        # brotli 压缩后的数据
-        if ver == 3 and not is_decompressed:
-            data = brotli.decompress(data[16:])
-            self.process_dm(data, is_decompressed=True)
-            return
+    def _end_window(self) -> None:
+        self._attention_pending = False
+        if self._attention is not None and not self.closed:
+            self.on_attention(self._attention)
 
-        # ver 为1的时候为进入房间后或心跳包服务器的回应。op 为3的时候为房间的人气值。
-        if ver == 1 and op == 3:
-            attention = int(data[16:].hex(), 16)
-            self.logger.debug(
-                "[{room_id}][ATTENTION]  {attention}".format(room_id=self.room_id, attention=attention))
-            self.send_queue.put((time.time_ns(), self._dumps(
-                {
-                    "relay": {
-                        "roomid": self.room_id,
-                        "e": "heartbeat",
-                        "data": attention
-                    }
-                }
-            )))
+    def _flush_attention(self) -> None:
+        attention, self._attention = self._attention, None
+        if attention is None:
             return
+        self.relay(self._encode("heartbeat", attention), block=False)
+
+    def _build_templates(self) -> None:
+        """Encode the per-room parts of every relay message once
+        Events only serialize their data and token afterwards
+        """
+        room_id = codec.dumps(self.room_id)
+        heads = {e: b'{"relay":{"roomid":' + room_id + b',"e":' + codec.dumps(e) for e in
+                 self.DATA_EVENTS + self.STATUS_EVENTS}
+        self._data_heads: dict[str, bytes] = {e: heads[e] + b',"data":' for e in self.DATA_EVENTS}
+        self._status_msgs: dict[str, bytes] = {e: heads[e] + b"}}" for e in self.STATUS_EVENTS}
+        self._token_heads: dict[str, str] = {e: f"{self.room_id}_{e}_" for e in self.DATA_EVENTS}
 
-        # ver 不为2也不为1目前就只能是0了，也就是普通的 json 数据。
-        # op 为5意味着这是通知消息，cmd 基本就那几个了。
-        if op == 5:
+    def _encode(self, event: str, data, token: Optional[str] = None) -> bytes:
+        if token is None:
+            return self._data_heads[event] + codec.dumps(data) + b"}}"
+        return b"".join((self._data_heads[event], codec.dumps(data), b',"token":', codec.dumps(token), b"}}"))
+
+    def process_dm(self, data):
+        self._relay_deadline = time.monotonic() + self.RELAY_TIMEOUT
+        # 一个 ws 帧里可能有多个数据包, 压缩过的数据包会被展开
+        for ver, op, body in dm_packet.decode(data):
+            self.messages += 1
+            # op 为3的时候为房间的人气值, 是进入房间后或心跳包服务器的回应。
+            if op == dm_packet.OP_HEARTBEAT_REPLY:
+                attention = dm_packet.read_int(body)
+                self.logger.debug("[%s][ATTENTION]  %s", self.room_id, attention)
+                self.on_attention(attention)
+            # op 为5意味着这是通知消息，cmd 基本就那几个了。
+            elif op == dm_packet.OP_MESSAGE:
+                self.process_msg(body)
+            elif op == dm_packet.OP_AUTH_REPLY:
+                if self.logger.isEnabledFor(Logger.DEBUG):
+                    self.logger.debug("[%s][AUTH]  %s", self.room_id, str(body, "utf-8", "ignore"))
+
+    def process_msg(self, body):
+        # 先在字节层面找出 cmd, 没有处理函数的消息直接丢弃, 不做 json 解析
+        cmd = dm_packet.sniff_cmd(body)
+        if cmd is not None and cmd.partition(":")[0] not in self.HANDLERS:
+            return
+        try:
             try:
-                msg = ""
-                jd = json.loads(data[16:].decode('utf-8', errors='ignore'))
-                if jd["cmd"].startswith("DANMU_MSG"):
-                    info = jd["info"]
-                    if not info[0][9]:
-                        mid = info[2][0]
-                        timestamp = info[0][4]
-                        msg = self._dumps(
-                            {
-                                "relay": {
-                                    "roomid": self.room_id,
-                                    "e": "DANMU_MSG",
-                                    "data": {
-                                        "message": info[1],
-                                        "uname": info[2][1],
-                                        "timestamp": timestamp,
-                                        "mid": mid,
-                                    },
-                                    "token": f"{self.room_id}_DANMU_MSG_{mid}_{timestamp}"
-                                }
-                            }
-                        )
-                elif jd["cmd"] == "LIVE":
-                    msg = self._dumps(
-                        {
-                            "relay": {
-                                "roomid": self.room_id,
-                                "e": "LIVE"
-                            }
-                        }
-                    )
-                elif jd["cmd"] == "PREPARING":
-                    msg = self._dumps(
-                        {
-                            "relay": {
-                                "roomid": self.room_id,
-                                "e": "PREPARING"
-                            }
-                        }
-                    )
-                elif jd["cmd"] == "ROUND":
-                    msg = self._dumps(
-                        {
-                            "relay": {
-                                "roomid": self.room_id,
-                                "e": "ROUND"
-                            }
-                        }
-                    )
-                elif jd["cmd"] == "SEND_GIFT":
-                    data = jd["data"]
-                    mid = data["uid"]
-                    tid = data["tid"]
-                    msg = self._dumps(
-                        {
-                            "relay": {
-                                "roomid": self.room_id,
-                                "e": "SEND_GIFT",
-                                "data": {
-                                    "coinType": data["coin_type"],
-                                    "giftId": data["giftId"],
-                                    "totalCoin": data["total_coin"],
-                                    "uname": data["uname"],
-                                    "mid": mid
-                                },
-                                "token": f"{self.room_id}_SEND_GIFT_{mid}_{tid}"
-                            }
-                        }
-                    )
-                elif jd["cmd"] == "GUARD_BUY":
-                    data = jd["data"]
-                    mid = data["uid"]
-                    start_time = data["start_time"]
-                    msg = self._dumps(
-                        {
-                            "relay": {
-                                "roomid": self.room_id,
-                                "e": "GUARD_BUY",
-                                "data": {
-                                    "mid": mid,
-                                    "uname": data["username"],
-                                    "num": data["num"],
-                                    "price": data["price"],
-                                    "giftId": data["gift_id"],
-                                    "level": data["guard_level"]
-                                },
-                                "token": f"{self.room_id}_GUARD_BUY_{mid}_{start_time}"
-                            }
-                        }
-                    )
-                if msg:
-                    self.send_queue.put((0, msg))
-                    self.logger.debug(msg)
-            except Exception:
-                self.logger.error(traceback.format_exc())
+                jd = codec.loads(body)
+            except codec.DecodeError:
+                # 偶尔有截断的 UTF-8, 按旧逻辑忽略坏字节
+                jd = codec.loads(str(body, "utf-8", "ignore"))
+            handler = self.HANDLERS.get(jd["cmd"].partition(":")[0])
+            if handler is None:
+                return
+            handler(self, jd)
+        except Exception:
+            self.logger.error(traceback.format_exc())
+
+    @handles("DANMU_MSG")
+    def on_danmu_msg(self, jd):
+        info = jd["info"]
+        if info[0][9]:
+            return
+        mid = info[2][0]
+        timestamp = info[0][4]
+        token = f"{self._token_heads['DANMU_MSG']}{mid}_{timestamp}"
+        if self.is_relayed(token):
+            return
+        self.relay(self._encode("DANMU_MSG", {
+            "message": info[1],
+            "uname": info[2][1],
+            "timestamp": timestamp,
+            "mid": mid,
+        }, token), token=token)
+
+    @handles("LIVE", "PREPARING", "ROUND")
+    def on_live_status(self, jd):
+        self.relay(self._status_msgs[jd["cmd"]])
+
+    @handles("SEND_GIFT")
+    def on_send_gift(self, jd):
+        data = jd["data"]
+        mid = data["uid"]
+        tid = data["tid"]
+        token = f"{self._token_heads['SEND_GIFT']}{mid}_{tid}"
+        if self.is_relayed(token):
+            return
+        self.relay(self._encode("SEND_GIFT", {
+            "coinType": data["coin_type"],
+            "giftId": data["giftId"],
+            "totalCoin": data["total_coin"],
+            "uname": data["uname"],
+            "mid": mid
+        }, token), token=token)
+
+    @handles("GUARD_BUY")
+    def on_guard_buy(self, jd):
+        data = jd["data"]
+        mid = data["uid"]
+        start_time = data["start_time"]
+        token = f"{self._token_heads['GUARD_BUY']}{mid}_{start_time}"
+        if self.is_relayed(token):
+            return
+        self.relay(self._encode("GUARD_BUY", {
+            "mid": mid,
+            "uname": data["username"],
+            "num": data["num"],
+            "price": data["price"],
+            "giftId": data["gift_id"],
+            "level": data["guard_level"]
+        }, token), token=token)
 
     async def stop(self):
         self.closed = True
@@ -3,62 +3,134 @@ from __future__ import annotations
 import asyncio
 import threading
 import time
-from typing import Optional
+from typing import Callable, Optional
 
+from aiohttp import ClientSession, DummyCookieJar, TCPConnector
+
+import metrics
 from dm import BiliDM
 
 
 class DManager(threading.Thread):
+    """One event loop thread running a shard of the live rooms
+    Tracks its load as open sockets and relayed messages per second
+    Calls on_close from the loop thread as soon as a room stops
+    """
     _loop: Optional[asyncio.AbstractEventLoop]
-    _size: int
-    _LIMIT: int
-    _rooms: set[BiliDM]
+    _rooms: dict[int, BiliDM]
+    session: Optional[ClientSession]
     manager_started: bool
+    msg_rate: float
+    # 每个 ws 连接本身的负载, 折算为每秒消息数
+    SOCKET_COST: float = 5.0
+    RATE_INTERVAL: float = 5.0
+    ALPHA: float = 0.5
 
-    def __init__(self, index: int, size_limit: int = 50) -> None:
+    def __init__(self, index: int, on_close: Optional[Callable[[int], None]] = None) -> None:
         super().__init__(name=f"DManager-{str(index)}", daemon=True)
-        self._size = 0
-        self._LIMIT = size_limit
-        self._rooms = set()
+        self.on_close = on_close
+        self._rooms = {}
         self.manager_started = False
         self._loop = None
+        # 事件循环和 session 创建完成后置位
+        self._loop_ready = threading.Event()
+        self.session = None
+        self.msg_rate = 0.0
+        self._rate_time = time.monotonic()
+        # 已打开但还没连上弹幕服务器的直播间数, watch 时加一, 连上或关闭时减一
+        self._connecting = 0
+        self._connecting_lock = threading.Lock()
 
     def set_queue(self, send_queue) -> None:
-        [room.set_queue(send_queue) for room in self._rooms]
+        [room.set_queue(send_queue) for room in self._rooms.values()]
 
     def watch(self, room_id: int, send_queue) -> None:
-        while self._loop is None:
-            time.sleep(.1)
-        room = BiliDM(room_id, self._loop)
+        self._loop_ready.wait()
+        room = BiliDM(room_id, self._loop, self.session)
         room.set_queue(send_queue)
-        self._rooms.add(room)
-        self._size += 1
-        asyncio.run_coroutine_threadsafe(room.startup(), self._loop)
+        room.on_connected = self._leave_connecting
+        with self._connecting_lock:
+            self._connecting += 1
+        self._rooms[room_id] = room
+        asyncio.run_coroutine_threadsafe(self._run_room(room_id, room), self._loop)
+
+    async def _run_room(self, room_id: int, room: BiliDM) -> None:
+        try:
+            await room.startup()
+        finally:
+            room.closed = True
+            if not room.connected:
+                self._leave_connecting()
+            # 被迁移走的直播间已经不在这里, 不算关闭
+            if self._rooms.get(room_id) is room:
+                del self._rooms[room_id]
+                if self.on_close is not None:
+                    self.on_close(room_id)
+
+    def _leave_connecting(self) -> None:
+        with self._connecting_lock:
+            self._connecting -= 1
+
+    def release(self, room_id: int) -> Optional[BiliDM]:
+        """Stop a room so that it can be moved to another manager"""
+        room = self._rooms.pop(room_id, None)
+        if room is not None:
+            asyncio.run_coroutine_threadsafe(room.stop(), self._loop)
+        return room
 
-    def is_available(self) -> bool:
-        return self._size < self._LIMIT
+    @property
+    def size(self) -> int:
+        return len(self._rooms)
+
+    @property
+    def connecting(self) -> int:
+        return self._connecting
+
+    @property
+    def load(self) -> float:
+        return len(self._rooms) * self.SOCKET_COST + self.msg_rate
 
     def get_rooms(self) -> list[int]:
-        return [int(room.room_id) for room in self._rooms]
+        return list(self._rooms)
+
+    def room_rates(self) -> dict[int, float]:
+        return {room_id: room.msg_rate for room_id, room in list(self._rooms.items())}
 
-    def _clean_dead_rooms(self) -> None:
-        dead_rooms = []
-        for room in self._rooms:
-            if room.closed:
-                self._size -= 1
-                dead_rooms.append(room)
-        [self._rooms.remove(d_room) for d_room in dead_rooms]
+    def room_relayed(self) -> dict[int, int]:
+        return {room_id: room.relayed for room_id, room in list(self._rooms.items())}
+
+    def _update_rates(self) -> None:
+        now = time.monotonic()
+        elapsed, self._rate_time = now - self._rate_time, now
+        total = 0.0
+        for room in list(self._rooms.values()):
+            messages, room.messages = room.messages, 0
+            room.msg_rate += self.ALPHA * (messages / elapsed - room.msg_rate)
+            total += room.msg_rate
+        self.msg_rate = total
 
     async def startup(self) -> None:
         self.manager_started = True
+        asyncio.ensure_future(metrics.watch_loop_lag(self.name))
         while self.manager_started:
-            self._clean_dead_rooms()
-            await asyncio.sleep(.5)
+            await asyncio.sleep(self.RATE_INTERVAL)
+            self._update_rates()
+
+    @staticmethod
+    async def open_session() -> ClientSession:
+        """One keep-alive session shared by every room on this loop"""
+        return ClientSession(connector=TCPConnector(ttl_dns_cache=300, keepalive_timeout=60),
+                             cookie_jar=DummyCookieJar())
 
     def run(self) -> None:
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        self.session = loop.run_until_complete(self.open_session())
+        self._loop = loop
+        self._loop_ready.set()
         try:
-            self._loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(self._loop)
             self._loop.run_until_complete(self.startup())
         except KeyboardInterrupt:
             print("exit with keyboard")
+        finally:
+            self._loop.run_until_complete(self.session.close())
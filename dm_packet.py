@@ -0,0 +1,80 @@
+from __future__ import annotations
+
+import re
+import struct
+import zlib
+from typing import Iterator, Optional, Union
+
+import brotli
+
+# 数据包头: 包长度, 头部长度, 协议版本, 操作码, 序号 (大端)
+HEADER = struct.Struct(">IHHII")
+HEADER_LEN: int = HEADER.size
+
+# 协议版本
+PROTO_JSON = 0
+PROTO_INT = 1
+PROTO_ZLIB = 2
+PROTO_BROTLI = 3
+
+# 操作码
+OP_HEARTBEAT = 2
+OP_HEARTBEAT_REPLY = 3
+OP_MESSAGE = 5
+OP_AUTH = 7
+OP_AUTH_REPLY = 8
+
+Buffer = Union[bytes, bytearray, memoryview]
+
+_CMD_HEAD = re.compile(rb'\s*\{\s*"cmd"\s*:\s*"([^"\\]*)"')
+_CMD_ANY = re.compile(rb'"cmd"\s*:\s*"([^"\\]*)"')
+
+
+def encode(op: int, body: bytes = b"", ver: int = PROTO_INT, seq: int = 1) -> bytes:
+    """Build one packet with a 16-byte header"""
+    return HEADER.pack(HEADER_LEN + len(body), HEADER_LEN, ver, op, seq) + body
+
+
+# [object Object]
+HEARTBEAT: bytes = encode(OP_HEARTBEAT, b"[object Object]")
+
+
+def _frames(view: memoryview) -> Iterator[tuple[int, int, memoryview]]:
+    """Split concatenated packets without copying their bodies"""
+    unpack_from = HEADER.unpack_from
+    offset, end = 0, len(view)
+    while offset + HEADER_LEN <= end:
+        packet_len, header_len, ver, op, _ = unpack_from(view, offset)
+        if packet_len < header_len or offset + packet_len > end:
+            # 数据包长度不合法, 丢弃剩余部分
+            return
+        yield ver, op, view[offset + header_len:offset + packet_len]
+        offset += packet_len
+
+
+def decode(data: Buffer) -> Iterator[tuple[int, int, memoryview]]:
+    """Yield (protover, op, body) of every packet in a websockets frame
+    Compressed batches (protover 2/3) are expanded in place
+    """
+    for ver, op, body in _frames(memoryview(data)):
+        if ver == PROTO_BROTLI:
+            yield from _frames(memoryview(brotli.decompress(bytes(body))))
+        elif ver == PROTO_ZLIB:
+            yield from _frames(memoryview(zlib.decompress(body)))
+        else:
+            yield ver, op, body
+
+
+def sniff_cmd(body: Buffer) -> Optional[str]:
+    """Find the cmd of a notification without decoding the whole body
+    The cmd is almost always the first key, otherwise scan for it
+    """
+    match = _CMD_HEAD.match(body) or _CMD_ANY.search(body)
+    if match is None:
+        return None
+    return match.group(1).decode("utf-8", "ignore")
+
+
+def read_int(body: memoryview) -> int:
+    """Body of a heartbeat reply, the popularity value"""
+    return int.from_bytes(body[:4], "big")
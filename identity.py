@@ -0,0 +1,64 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+from uuid import uuid1
+
+import metrics
+
+
+class Identity:
+    """One anonymous visitor, sent as the cookie header of a request"""
+    __slots__ = ("buvid3", "cookie", "headers", "retired")
+
+    def __init__(self) -> None:
+        self.buvid3 = str(uuid1()).upper() + "infoc"
+        self.cookie = f"_uuid=; rpdid=; buvid3={self.buvid3}"
+        self.headers = {"cookie": self.cookie}
+        self.retired = False
+
+
+class IdentityPool:
+    """Pre-generated buvid3 identities handed out round robin
+    A flagged identity is replaced by a new one, the others keep working
+    When most of the pool is flagged within WINDOW the problem is the IP,
+    storming then tells the caller to back off the whole host
+    """
+    WINDOW: float = 60.0
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._identities = [Identity() for _ in range(size)]
+        self._next = 0
+        self._retired: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def get(self) -> Identity:
+        with self._lock:
+            identity = self._identities[self._next]
+            self._next = (self._next + 1) % self.size
+            return identity
+
+    def retire(self, identity: Identity) -> bool:
+        """Replace a flagged identity, return False if it already was"""
+        with self._lock:
+            if identity.retired:
+                return False
+            identity.retired = True
+            try:
+                index = self._identities.index(identity)
+            except ValueError:
+                return False
+            self._identities[index] = Identity()
+            self._retired.append(time.monotonic())
+        metrics.IDENTITIES_RETIRED.inc()
+        return True
+
+    @property
+    def storming(self) -> bool:
+        now = time.monotonic()
+        with self._lock:
+            while self._retired and now - self._retired[0] > self.WINDOW:
+                self._retired.popleft()
+            return len(self._retired) * 2 >= self.size
@@ -0,0 +1,253 @@
+from __future__ import annotations
+
+import asyncio
+import time
+from itertools import cycle
+from typing import Any, Awaitable, Callable, NoReturn, Optional
+
+from aiohttp import ClientSession, DummyCookieJar
+from aiohttp.client_exceptions import ClientError
+from async_timeout import timeout
+
+import codec
+from cache import SizedTTLCache
+from identity import Identity, IdentityPool
+import metrics
+from logger import Logger
+from network import NetworkOptions
+from pull_controller import PullController
+from rate_limit import HostLimiter, RateLimited
+from send_scheduler import JOB
+from tracing import JobTrace, Tracer
+from wbi import WbiSigner
+
+
+class ResponseTooLarge(Exception):
+    pass
+
+
+class JobExecutor:
+    """Run http jobs on shared sessions, one per source address
+    Jobs take the sessions in turn
+    Keep up to max_inflight fetches running at the same time
+    """
+    _HEADERS = {
+        "origin": "https://space.bilibili.com",
+        "referer": "https://space.bilibili.com/",
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+    }
+    TIMEOUT: int = 10
+
+    def __init__(self, max_inflight: int, network: int, logger: Logger,
+                 controller: Optional[PullController] = None, tracer: Optional[Tracer] = None,
+                 cache: Optional[SizedTTLCache] = None, max_response_size: int = 4 << 20,
+                 limiter: Optional[HostLimiter] = None, signer: Optional[WbiSigner] = None,
+                 identities: Optional[IdentityPool] = None, options: Optional[NetworkOptions] = None) -> None:
+        self.MAX_INFLIGHT = max_inflight
+        self.NETWORK = network
+        self.logger: Any = logger
+        self.controller = controller
+        self.tracer = tracer or Tracer(0)
+        self.cache = cache
+        self.MAX_RESPONSE_SIZE = max_response_size
+        self.limiter = limiter or HostLimiter(0)
+        self.signer = signer
+        self.identities = identities or IdentityPool(1)
+        self.options = options or NetworkOptions()
+        # 每个 session 绑定的源地址
+        self._sources: dict[ClientSession, Optional[str]] = {}
+        # 正在请求中的 url, 相同 url 的任务等待同一个结果
+        self._flights: dict[str, asyncio.Future] = {}
+        self.inflight: int = 0
+        self.closed: bool = False
+
+    async def fetch(self, client: ClientSession, url: str) -> tuple[int, str]:
+        """Return the status and the body decoded as UTF-8
+        Bodies over MAX_RESPONSE_SIZE raise ResponseTooLarge
+        Requests are paced per host, risk-control responses raise RateLimited
+        Each request carries the cookie of the next identity in the pool
+        """
+        limit, limiter = self.MAX_RESPONSE_SIZE, self.limiter
+        host = await limiter.acquire(url, self.TIMEOUT / 2, self._sources.get(client))
+        if self.signer is not None and self.signer.needs_sign(url):
+            # 缓存和合并请求仍按原 url, 只有实际请求带上签名
+            url = self.signer.sign(url)
+        identity = self.identities.get()
+        async with client.get(url, headers=identity.headers) as resp:
+            if limiter.is_risky(resp.status):
+                self.on_risk(host)
+            if resp.content_length is not None and resp.content_length > limit:
+                raise ResponseTooLarge(resp.content_length)
+            body = bytearray()
+            async for chunk in resp.content.iter_chunked(1 << 16):
+                body += chunk
+                if len(body) > limit:
+                    raise ResponseTooLarge(len(body))
+        if limiter.is_risky(resp.status, body):
+            self.on_flagged(host, identity)
+        limiter.on_response(host, False)
+        # 结果以 text 帧发送, 不是合法 UTF-8 的内容按失败处理
+        return resp.status, body.decode("utf-8")
+
+    def on_risk(self, host: str) -> NoReturn:
+        if (cooldown := self.limiter.on_response(host, True)) is not None:
+            self.logger.warning(f"{host} 触发风控, 暂停请求 {cooldown:.0f}s")
+        raise RateLimited(host, cooldown or 0.0)
+
+    def on_flagged(self, host: str, identity: Identity) -> NoReturn:
+        """Retire an identity flagged by a -352/-412 body
+        Only back off the host when most of the pool gets flagged
+        """
+        # 同一身份的并发请求可能先后被风控, 已换掉的身份只算这个身份失败
+        if self.identities.retire(identity):
+            self.logger.info(f"buvid3 {identity.buvid3} 被风控, 已更换")
+        if self.identities.storming:
+            self.on_risk(host)
+        raise RateLimited(host, 0.0)
+
+    async def fetch_shared(self, client: ClientSession, url: str) -> str:
+        """Fetch url once for every job asking for it at the same time
+        2xx responses are kept in the cache for its ttl
+        """
+        if self.cache is not None and (body := self.cache.get(url)) is not None:
+            metrics.CACHE_HITS.inc()
+            return body
+        if (flight := self._flights.get(url)) is not None:
+            metrics.FETCH_COALESCED.inc()
+            return await asyncio.shield(flight)
+        flight = self._flights[url] = asyncio.get_running_loop().create_future()
+        try:
+            status, body = await self.fetch(client, url)
+        except asyncio.CancelledError:
+            # 发起者超时被取消, 等待者按失败处理
+            flight.set_exception(asyncio.TimeoutError())
+            raise
+        except BaseException as e:
+            flight.set_exception(e)
+            raise
+        else:
+            flight.set_result(body)
+            # 错误页面照常返回给任务, 但不缓存
+            if self.cache is not None and 200 <= status < 300:
+                self.cache.set(url, body)
+            return body
+        finally:
+            del self._flights[url]
+            if flight.done() and not flight.cancelled():
+                # 没有等待者时避免 "exception was never retrieved"
+                flight.exception()
+
+    async def execute(self, client: ClientSession, key: str, url: str) -> Optional[bytes]:
+        """Fetch one job and build the result frame
+        Return None if the job failed
+        """
+        start = time.time()
+        try:
+            async with timeout(self.TIMEOUT):
+                body = await self.fetch_shared(client, url)
+        except (OSError, ClientError, TimeoutError, asyncio.TimeoutError):
+            self.logger.info(f"Job {key} failed.")
+            return None
+        except (ResponseTooLarge, UnicodeDecodeError, RateLimited) as e:
+            self.logger.warning(f"Job {key} failed: {type(e).__name__} {e}")
+            if isinstance(e, RateLimited) and self.controller is not None:
+                self.controller.on_limited(e.wait)
+            return None
+        result: bytes = codec.dumps({"key": key, "data": body})
+        self.logger.info(f"Job {key} completed in {str(time.time() - start)[:5]}s.")
+        return result
+
+    async def _run_job(self, client: ClientSession, key: str, url: str, send: Callable[[Any], Any],
+                       trace: Optional[JobTrace] = None) -> None:
+        self.inflight += 1
+        start = time.monotonic()
+        if trace is not None:
+            trace.fetch_start = time.time_ns()
+        try:
+            result = await self.execute(client, key, url)
+        finally:
+            self.inflight -= 1
+        if trace is not None:
+            trace.fetch_end = time.time_ns()
+        latency = time.monotonic() - start
+        metrics.FETCH_SECONDS.observe(latency)
+        (metrics.JOBS_COMPLETED if result is not None else metrics.JOBS_FAILED).inc()
+        if self.controller is not None:
+            self.controller.on_done(latency, result is not None)
+        if result is None:
+            self.tracer.finish(trace, ok=False)
+            return
+        if trace is not None:
+            trace.queued = time.time_ns()
+        # trace 随结果进入上传队列, 发送后由 ws_send 结束
+        if asyncio.iscoroutine(sent := send((JOB, result, trace))):
+            await sent
+
+    async def run(self,
+                  next_job: Callable[[], Awaitable[Optional[tuple[int, str, str]]]],
+                  send: Callable[[Any], Any]) -> None:
+        """Pull jobs from next_job and send each result as soon as it completes
+        next_job returns None when there is no job for now
+        send may be a coroutine function, so a full queue holds back the job
+        """
+        semaphore = asyncio.Semaphore(self.MAX_INFLIGHT)
+        pending: set[asyncio.Task] = set()
+
+        def done(task: asyncio.Task) -> None:
+            pending.discard(task)
+            semaphore.release()
+
+        network = self.NETWORK
+        clients = self.open_sessions(network)
+        rotation = cycle(clients)
+
+        def next_client() -> tuple[ClientSession, Optional[str]]:
+            client = next(rotation)
+            return client, self._sources.get(client)
+
+        refresher = asyncio.ensure_future(self.signer.keep_fresh(next_client)) if self.signer is not None else None
+        try:
+            while not self.closed:
+                await semaphore.acquire()
+                job = await next_job()
+                if job is None:
+                    semaphore.release()
+                    continue
+                if network != self.NETWORK:
+                    # 网络设置已重新加载, 旧连接池等其上的任务完成后关闭
+                    network = self.NETWORK
+                    asyncio.ensure_future(self._retire(clients, set(pending)))
+                    clients = self.open_sessions(network)
+                    rotation = cycle(clients)
+                received, key, url = job
+                trace = self.tracer.start(key, received)
+                task = asyncio.ensure_future(self._run_job(next(rotation), key, url, send, trace))
+                pending.add(task)
+                task.add_done_callback(done)
+        finally:
+            if refresher is not None:
+                refresher.cancel()
+            [task.cancel() for task in pending]
+            await self._close(clients)
+
+    def open_session(self, network: int, address: Optional[str] = None) -> ClientSession:
+        # 不保存响应设置的 cookie, 每个请求只带自己身份的 cookie
+        client = ClientSession(headers=self._HEADERS, connector=self.options.connector(network, address),
+                               cookie_jar=DummyCookieJar())
+        self._sources[client] = address
+        return client
+
+    def open_sessions(self, network: int) -> list[ClientSession]:
+        return [self.open_session(network, address) for address in self.options.addresses(network)]
+
+    async def _close(self, clients: list[ClientSession]) -> None:
+        for client in clients:
+            self._sources.pop(client, None)
+            await client.close()
+
+    async def _retire(self, clients: list[ClientSession], tasks: set[asyncio.Task]) -> None:
+        await asyncio.gather(*tasks, return_exceptions=True)
+        await self._close(clients)
+
+    def close(self) -> None:
+        self.closed = True
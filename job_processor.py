@@ -1,61 +1,97 @@
 from __future__ import annotations
 
 import asyncio
-import hashlib
-import json
+import sys
 import time
-from queue import Queue
-from threading import Thread
+from queue import Empty, Full, Queue
+from threading import Event, Thread, current_thread
 from typing import Any
 
-from aiohttp import ClientSession, TCPConnector
-from aiohttp.client_exceptions import ClientError
-from async_timeout import timeout
-from functools import reduce
-from random import random
-from urllib.parse import quote, urlencode, urlsplit, parse_qsl
 from websockets.exceptions import ConnectionClosed
 
+import codec
+import metrics
+from cache import SizedTTLCache
+from config_parser import Config
+from dm import BiliDM
+from identity import IdentityPool
+from job_executor import JobExecutor
 from logger import Logger
-from uuid import uuid1
+from network import NetworkOptions
+from pull_controller import PullController
+from rate_limit import HostLimiter
+from room_picker import RoomPicker
+from send_scheduler import CLASS_NAMES, CONTROL, SendScheduler
+from tracing import Tracer
+from wbi import WbiSigner
 from ws_live import WSLive
 
 
 class JobProcessor:
-    _img: str
-    _sub: str
-    _mixin: str
-    TASK_TYPES = ("pull_task", "receive", "handle", "ws_send", "ws_recv")
+    TASK_TYPES = ("pull_task", "receive", "handle", "ws_send", "ws_recv", "monitor")
 
-    def __init__(self,
-                 interval: int,
-                 max_size: int,
-                 ws_limit: int,
-                 network: int):
-        self.INTERVAL: float = interval / 1000.0
-        self.MAX_SIZE, self.WS_LIMIT, self.NETWORK = max_size, ws_limit, network
+    def __init__(self, config: Config):
+        self.config = config
+        self.INTERVAL: float = config.interval / 1000.0
+        self.MAX_SIZE, self.WS_LIMIT, self.NETWORK = config.max_size, config.ws_limit, config.network
+        self.MAX_INFLIGHT = config.max_inflight
+        self.pull = PullController(self.INTERVAL, self.MAX_SIZE, self.MAX_INFLIGHT, config.pull_mode == "adaptive")
+        self.executor = None
         self.websockets = None
-        self._img = self._sub = self._mixin = ""
-        self.task_queue: Queue = Queue()
-        self.send_queue = Queue()
-        self.recv_queue = Queue()
+        self.task_queue: Queue = Queue(maxsize=config.task_queue_size)
+        self.send_queue = SendScheduler(config.send_weights, config.send_policy == "strict",
+                                        config.send_queue_size, config.send_drop_policy)
+        self.recv_queue = Queue(maxsize=config.recv_queue_size)
         self.err_queue = Queue()
         self.tasks = []
         self.logger: Any = Logger(
             logger_name="job", level=Logger.INFO)
         self.closed = self.ready = False
-        self.bili_ws = WSLive(self.WS_LIMIT)
+        self.limiter = HostLimiter(config.rate_limit, config.risk_cooldown)
+        self.identities = IdentityPool(config.identity_pool)
+        BiliDM.configure(config.heartbeat_window, config.dedupe_ttl, config.dedupe_size, self.limiter,
+                         self.identities)
+        self.signer = WbiSigner(self.limiter)
+        self.bili_ws = WSLive(self.WS_LIMIT, config.ws_loops)
+        self.picker = RoomPicker(config.connect_rate, max_connecting=max(int(config.connect_rate * 5), 1))
+        # 1.3.0 起暂停弹幕采集, 开启 relay 后才会拉取直播间
+        self.task_types = self.TASK_TYPES + (("pull_ws",) if config.relay and self.WS_LIMIT > 0 else ())
+        self.tracer = Tracer(config.trace_size, config.trace_file)
+        self.cache = (SizedTTLCache(config.cache_size << 20, config.cache_ttl, sys.getsizeof)
+                      if config.cache_ttl > 0 else None)
+        self.register_metrics()
+
+    def register_metrics(self) -> None:
+        """Expose queue depths and room state, read only when scraped"""
+        registry = metrics.REGISTRY
+        registry.collector("dd_queue_depth", "Messages waiting in each queue", lambda: {
+            "task": self.task_queue.qsize(),
+            "recv": self.recv_queue.qsize(),
+            **{f"send_{name}": s["depth"] for name, s in self.send_queue.stats(reset=False).items()},
+        }, ("queue",))
+        registry.collector("dd_send_dropped_total", "Outbound messages dropped by the queue policy",
+                           lambda: dict(zip(CLASS_NAMES, self.send_queue.drops)), ("class",), kind="counter")
+        registry.collector("dd_cache_bytes", "Size of the cached responses",
+                           lambda: self.cache.nbytes if self.cache is not None else 0)
+        registry.collector("dd_jobs_inflight", "Jobs being fetched",
+                           lambda: self.executor.inflight if self.executor is not None else 0)
+        registry.collector("dd_manager_rooms", "Live rooms on each DManager event loop",
+                           lambda: {m.name: m.size for m in self.bili_ws.managers}, ("manager",))
+        registry.collector("dd_room_message_rate", "Danmaku packets per second of each room",
+                           lambda: {k: v for m in self.bili_ws.managers for k, v in m.room_rates().items()}, ("room",))
+        registry.collector("dd_room_relayed_total", "Messages relayed for each room",
+                           lambda: {k: v for m in self.bili_ws.managers for k, v in m.room_relayed().items()},
+                           ("room",), kind="counter")
+        registry.collector("dd_host_rate", "Allowed requests per second of each upstream host",
+                           lambda: {host: s["rate"] for host, s in self.limiter.stats().items()}, ("host",))
+        registry.collector("dd_host_blocked_seconds", "Remaining risk-control cooldown of each upstream host",
+                           lambda: {host: s["blocked"] for host, s in self.limiter.stats().items()}, ("host",))
+        registry.routes["/traces"] = lambda: ("application/x-ndjson", self.tracer.dump())
 
     class TaskProcessor(Thread):
-        _HEADERS = {
-        "cookie": f"_uuid=; rpdid=; buvid3={str(uuid1()).upper() + 'infoc'}",
-        "origin": "https://space.bilibili.com",
-        "referer": "https://space.bilibili.com/",
-        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
-    }
-        
-        def __init__(self, task_type: str, task_queue: Queue, send_queue: Queue, recv_queue: Queue, err_queue: Queue,
-                     interval: int, max_size: int, ws_limit: int, network: int, bili_ws: WSLive, logger: Logger, websockets) -> None:
+        def __init__(self, task_type: str, task_queue: Queue, send_queue: SendScheduler, recv_queue: Queue, err_queue: Queue,
+                     interval: int, max_size: int, ws_limit: int, network: int, bili_ws: WSLive, executor: JobExecutor,
+                     pull: PullController, picker: RoomPicker, logger: Logger, websockets) -> None:
             assert task_type in ("pull_task", "receive", "handle", "pull_ws", "ws_send", "ws_recv", "monitor")
             super().__init__(name=f"TaskProcessor-{task_type}", daemon=True)
             self.task_type = task_type
@@ -68,39 +104,60 @@ class JobProcessor:
             self.WS_LIMIT = ws_limit
             self.NETWORK = network
             self.bili_ws = bili_ws
+            self.executor = executor
+            self.pull = pull
+            self.picker = picker
             self.websockets = websockets
             self.logger = logger
             self.ready = self.closed = False
+            # 关闭时唤醒正在等待的循环, 以便 close() 等待线程退出
+            self.stopped = Event()
+            self.freed = Event()
         
         def set_ready(self) -> None:
             self.ready = True
         
         def set_closed(self) -> None:
             self.closed = True
+            self.stopped.set()
+            self.freed.set()
 
-        @staticmethod
-        async def fetch(client, url):
-            async with client.get(url) as resp:
-                return await resp.text(encoding="utf-8")
-            
-        def monitor(self):
+        def put(self, queue: Queue, item: Any) -> None:
+            """Block while queue is full, so the producer stops reading
+            Give up once the processor is closed
+            """
             while not self.closed:
-                time.sleep(60)
+                try:
+                    queue.put(item, timeout=1)
+                    return
+                except Full:
+                    continue
+
+        def monitor(self):
+            while not self.stopped.wait(60):
                 self.logger.info(f"OPEN: {str(self.bili_ws.rooms)} | LIVE: {len(self.bili_ws.lived)} | "
                                  f"LIMIT: {self.WS_LIMIT}")
+                self.logger.info(JobProcessor.format_send_stats(self.send_queue.stats()))
+                self.logger.info(self.pull.stats())
+                if self.executor.tracer.enabled:
+                    self.logger.info(self.executor.tracer.format_summary())
 
         def pull_task(self) -> None:
             """Pull a task from websockets server
             Send string "DDDhttp" to server
-            It is able to pull another task before the last task finished
+            The pull controller decides by job backlog and in-flight count
             """
             while not self.ready:
                 time.sleep(1)
+            pull = self.pull
             while not self.closed:
-                if self.send_queue.qsize() < self.MAX_SIZE:
-                    self.send_queue.put((time.time_ns(), "DDDhttp"))
+                for _ in range(pull.should_pull(self.task_queue.qsize(), self.executor.inflight)):
+                    # 控制队列已满时本轮不再拉取
+                    if not self.send_queue.put((CONTROL, "DDDhttp")):
+                        break
+                    pull.on_pull()
                     # self.logger.debug("Send \"DDDhttp\"")
-                time.sleep(self.INTERVAL)
+                self.stopped.wait(pull.delay)
         
         def receive_task(self) -> None:
             """Receive a task from websockets server
@@ -108,96 +165,99 @@ class JobProcessor:
             """
             while not self.ready:
                 time.sleep(1)
-            queue_put = self.task_queue.put
             recv = self.recv_queue.get
             while not self.closed:
-                _, receive_text = recv()
-                text: Any = json.loads(receive_text)
+                try:
+                    received, receive_text = recv(timeout=1)
+                except Empty:
+                    continue
+                text: Any = codec.loads(receive_text)
                 if "empty" in text:
+                    self.pull.on_reply(empty=True)
                     self.logger.debug(f"No job, wait.")
                 elif "data" in text:
                     task_type = text["data"].get("type", None)
                     if task_type == "http":
-                        queue_put(
-                            (time.time_ns(), text["key"], text["data"]["url"]), block=False)
+                        self.pull.on_reply(empty=False)
+                        self.put(self.task_queue, (received, text["key"], text["data"]["url"]))
+                        metrics.JOBS_RECEIVED.inc()
                         self.logger.info(f"Job {text['key']} received.")
                     elif task_type == "query":
                         result = text["data"].get("result", None)
-                        if self.bili_ws.started:
+                        if not self.picker.on_reply(text.get("key")):
+                            self.logger.debug(f"Unmatched query reply {text.get('key')}")
+                        if self.bili_ws.started and self.bili_ws.free:
                             self.bili_ws.watch(result)
         
         async def handle(self):
             """Handle http task and send back to server
+            Jobs are run by the executor with bounded concurrency
             """
+            loop = asyncio.get_event_loop()
             queue_get = self.task_queue.get
-            send = self.send_queue.put
-            json_dumps = json.dumps
-            async with ClientSession(headers=self._HEADERS,
-                                     connector=TCPConnector(family=self.NETWORK)) as client:
-                while not self.closed:
-                    _, key, url = queue_get()
-                    start = time.time()
-                    try:
-                        async with timeout(10):
-                            # resp = await self.fetch(client, url)
-                            # url_split = urlsplit(url)
-                            # if "wbi" in str(url_split.path):
-                            #     query = dict(parse_qsl(url_split.query))
-                            #     w_rid, wts = await self.enc_wbi(query)
-                            #     query.update({
-                            #         "w_rid": w_rid,
-                            #         "wts": wts
-                            #     })
-                            #     query = {new_key: quote(query[new_key]) for new_key in query}
-                            #     url = "".join([url.split("?")[0], "?", urlencode(query, encoding="utf-8")])
-                            #     self.logger.debug(f"New url: {url}")
-                            resp = await self.fetch(client, url)
-                            client.headers.update({"cookie": f"_uuid=; rpdid=; buvid3={str(uuid1()).upper() + 'infoc'}"})
-                    except (OSError, ClientError, TimeoutError, asyncio.TimeoutError):
-                        self.logger.info(f"Job {key} failed.")
-                        continue
-                    # self._HEADERS["cookie"] = f"_uuid=; rpdid=; buvid3={str(uuid1()).upper() + 'infoc'}"
-                    result: dict[str, str] = {
-                        "key": key,
-                        "data": resp,
-                    }
-                    result: str = json_dumps(
-                        result, ensure_ascii=False, separators=(",", ":"))
-                    send((0, result))
-                    self.logger.info(f"Job {key} completed in {str(time.time() - start)[:5]}s.")
-        
+
+            def get_job():
+                try:
+                    return queue_get(timeout=1)
+                except Empty:
+                    return None
+
+            async def next_job():
+                return await loop.run_in_executor(None, get_job)
+
+            lag = asyncio.ensure_future(metrics.watch_loop_lag("handle"))
+            try:
+                await self.executor.run(next_job, self.send_queue.put_async)
+            finally:
+                lag.cancel()
+
         def pull_ws(self):
-            """Pull a live room ws task from server."""
-            while not self.closed:
-                time.sleep(5)
-                if self.bili_ws.rooms == len(self.bili_ws.lived) and self.bili_ws.rooms < self.WS_LIMIT:
-                    payload = {
-                        "key": str(random()),
-                        "query": {"type": "pickRoom"}
-                    }
-                    result = json.dumps(
-                        payload, ensure_ascii=False, separators=(",", ":"))
-                    self.send_queue.put((time.time_ns(), result))
+            """Pull live room ws tasks from server.
+            Keep pickRoom queries outstanding up to the free capacity
+            Wake up as soon as WSLive reports a closed room
+            """
+            freed = self.freed
+            self.bili_ws.add_listener(freed.set)
+            try:
+                while not self.closed:
+                    free = self.bili_ws.free
+                    for query in self.picker.queries(free, self.bili_ws.connecting):
+                        self.send_queue.put((CONTROL, query))
+                    freed.wait(self.picker.delay(free))
+                    freed.clear()
+            finally:
+                self.bili_ws.remove_listener(freed.set)
         
         def ws_send(self):
+            send = codec.text_sender(self.websockets.send)
             while not self.closed:
-                _, msg = self.send_queue.get()
                 try:
-                    self.websockets.send(msg)
+                    _, msg, trace = self.send_queue.get(timeout=1)
+                except Empty:
+                    continue
+                try:
+                    send(msg)
                 except Exception as e:
                     self.err_queue.put(str(e))
                     return
-                self.logger.debug(f"Send {msg}")
+                if trace is not None:
+                    trace.sent = time.time_ns()
+                    self.executor.tracer.finish(trace)
+                metrics.CLUSTER_SENT.inc()
+                self.logger.debug("Send %s", msg)
         
         def ws_recv(self):
             while not self.closed:
                 try:
-                    receive_msg = self.websockets.recv()
+                    receive_msg = self.websockets.recv(timeout=1)
+                except TimeoutError:
+                    continue
                 except Exception as e:
                     self.err_queue.put(str(e))
                     return
-                self.recv_queue.put((time.time_ns(), receive_msg))
-                self.logger.debug(f"Receive {receive_msg}")
+                self.put(self.recv_queue, (time.time_ns(), receive_msg))
+                metrics.CLUSTER_RECEIVED.inc()
+                self.logger.debug("Receive %s", receive_msg)
         
         def run(self) -> None:
             self.set_ready()
@@ -222,13 +282,19 @@ class JobProcessor:
     def startup(self, websockets):
         self.websockets = websockets
         self.bili_ws.set_queue(self.send_queue)
+        self.pull.reset()
+        self.picker.reset()
+        self.executor = JobExecutor(self.MAX_INFLIGHT, self.NETWORK, self.logger, self.pull, self.tracer, self.cache,
+                                    self.config.max_response_size << 10, self.limiter, self.signer,
+                                    self.identities, NetworkOptions.from_config(self.config))
         self.tasks = [
             self.TaskProcessor(t_type, self.task_queue, self.send_queue, self.recv_queue, self.err_queue,
                                self.INTERVAL, self.MAX_SIZE, self.WS_LIMIT, self.NETWORK,
-                               self.bili_ws, self.logger, websockets)
-            for t_type in self.TASK_TYPES
+                               self.bili_ws, self.executor, self.pull, self.picker, self.logger, websockets)
+            for t_type in self.task_types
         ]
-        if not self.bili_ws.started:
+        # 只有开启 relay 时才启动弹幕事件循环线程
+        if "pull_ws" in self.task_types and not self.bili_ws.is_alive():
             self.bili_ws.start()
         [t.start() for t in self.tasks]
         while not all([t.closed for t in self.tasks]) and self.err_queue.empty():
@@ -236,46 +302,26 @@ class JobProcessor:
         if not self.err_queue.empty():
             raise ConnectionClosed(None, None)
 
-    @staticmethod
-    def get_mixin_key(ae):
-        oe = [46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49, 33, 9, 42, 19, 29, 28, 14, 39,
-              12,
-              38, 41,
-              13, 37, 48, 7, 16, 24, 55, 40, 61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63, 57, 62, 11,
-              36,
-              20, 34, 44, 52]
-        le = reduce(lambda s, i: s + ae[i], oe, "")
-        return le[:32]
-
-    async def update_wbi(self):
-        self.ready = True
-        # await asyncio.sleep(.1)
-        # while not self.closed:
-        #     try:
-        #         with timeout(10):
-        #             async with self.client.get("https://api.bilibili.com/x/web-interface/nav") as resp:
-        #                 resp = json.loads(await resp.text(encoding="utf-8"))
-        #     except (OSError, ClientError, TimeoutError):
-        #         continue
-        #     wbi_img: dict = resp["data"]["wbi_img"]
-        #     img_url: str = wbi_img.get("img_url")
-        #     sub_url: str = wbi_img.get("sub_url")
-        #     self._img = img_url.split("/")[-1].split(".")[0]
-        #     self._sub = sub_url.split("/")[-1].split(".")[0]
-        #     self._mixin = self.get_mixin_key(self._img + self._sub)
-        #     self.logger.debug(f"Update mixin key: {self._mixin}")
-        #     if not self.ready:
-        #         self.ready = True
-        #     await asyncio.sleep(300)
+    def apply_config(self, config: Config) -> None:
+        """Apply interval, max_size, ws_limit and network without reconnecting"""
+        self.config = config
+        self.INTERVAL = config.interval / 1000.0
+        self.MAX_SIZE, self.WS_LIMIT, self.NETWORK = config.max_size, config.ws_limit, config.network
+        self.pull.update(self.INTERVAL, self.MAX_SIZE, self.MAX_INFLIGHT)
+        self.bili_ws.set_limit(self.WS_LIMIT)
+        if self.executor is not None:
+            self.executor.NETWORK = self.NETWORK
+        for t in self.tasks:
+            if isinstance(t, Thread):
+                t.INTERVAL, t.MAX_SIZE, t.WS_LIMIT, t.NETWORK = self.INTERVAL, self.MAX_SIZE, self.WS_LIMIT, self.NETWORK
 
-    async def enc_wbi(self, params: dict):
-        wts = int(time.time())
-        params = params.copy()
-        params["wts"] = wts
-        params = {new_key: params[new_key] for new_key in sorted(params.keys())}
-        query = urlencode(query=params, encoding="utf-8")
-        w_rid = hashlib.md5((query + self._mixin).encode(encoding='utf-8')).hexdigest()
-        return w_rid, wts
+    @staticmethod
+    def format_send_stats(stats: dict[str, dict[str, float]]) -> str:
+        return " | ".join(
+            f"{name.upper()}: {int(s['depth'])} queued, {int(s['sent'])} sent, {int(s['dropped'])} dropped, "
+            f"wait {s['avg_wait_ms']:.1f}/{s['max_wait_ms']:.1f}ms"
+            for name, s in stats.items()
+        )
 
     def close(self):
         """Close connection pool
@@ -283,8 +329,14 @@ class JobProcessor:
         """
         self.closed: bool = True
         # self.bili_ws.ws_close()
-        (t.set_closed() for t in self.tasks)
-        (t.join() for t in self.tasks)
+        if self.executor is not None:
+            self.executor.close()
+        [t.set_closed() for t in self.tasks]
+        # 旧线程全部退出后才能重连, 否则旧的 ws_send 可能取走新连接的消息
+        for t in self.tasks:
+            if t is not current_thread():
+                t.join()
+        self.tracer.close()
         self.err_queue.queue.clear()
 
     @staticmethod
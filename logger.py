@@ -1,11 +1,74 @@
 from __future__ import annotations
 
+import atexit
 import os
-from logging import StreamHandler, FileHandler, Formatter, DEBUG, INFO, WARN, WARNING, ERROR, CRITICAL
+import threading
+from logging import StreamHandler, FileHandler, Formatter, LogRecord, DEBUG, INFO, WARN, WARNING, ERROR, CRITICAL
 from logging import Logger as DefaultLogger
+from logging.handlers import QueueHandler, QueueListener
+from queue import SimpleQueue
 from time import strftime, localtime
 from typing import Optional
 
+LOG_DIR = os.path.join(os.path.realpath(os.path.dirname(__file__)), "logs")
+
+
+class DailyFileHandler(FileHandler):
+    """Write to logs/YYYY-MM-DD.log and switch to a new file when the date changes"""
+
+    def __init__(self, directory: str) -> None:
+        self.directory = directory
+        self.date = strftime("%Y-%m-%d", localtime())
+        super().__init__(filename=self._filename(), mode="a", encoding="utf-8", delay=True)
+
+    def _filename(self) -> str:
+        return os.path.join(self.directory, "{log_time}.log".format(log_time=self.date))
+
+    def emit(self, record: LogRecord) -> None:
+        date = strftime("%Y-%m-%d", localtime(record.created))
+        if date != self.date:
+            self.date = date
+            self.close()
+            self.baseFilename = os.path.abspath(self._filename())
+        super().emit(record)
+
+
+class _Backend:
+    """Handlers shared by every Logger in the process
+    Records go through a queue and are written by one background thread
+    """
+    _lock = threading.Lock()
+    _listener: Optional[QueueListener] = None
+    handler: Optional[QueueHandler] = None
+
+    @classmethod
+    def get_handler(cls) -> QueueHandler:
+        with cls._lock:
+            if cls.handler is None:
+                try:
+                    os.makedirs(LOG_DIR)
+                except (FileExistsError, OSError):
+                    pass
+                formatter = Formatter(fmt="%(asctime)s - [%(levelname)s] %(message)s")
+                stream_handler = StreamHandler()
+                file_handler = DailyFileHandler(LOG_DIR)
+                stream_handler.setFormatter(formatter)
+                file_handler.setFormatter(formatter)
+                queue: SimpleQueue = SimpleQueue()
+                cls._listener = QueueListener(queue, stream_handler, file_handler)
+                cls._listener.start()
+                cls.handler = QueueHandler(queue)
+                atexit.register(cls.stop)
+            return cls.handler
+
+    @classmethod
+    def stop(cls) -> None:
+        """Flush the queued records before the process exits"""
+        with cls._lock:
+            if cls._listener is not None:
+                cls._listener.stop()
+                cls._listener = None
+
 
 class Logger(DefaultLogger):
     INFO = INFO
@@ -21,27 +84,9 @@ class Logger(DefaultLogger):
         self.set_logger()
 
     def set_logger(self) -> None:
-        try:
-            os.makedirs(os.path.join(os.path.realpath(os.path.dirname(__file__)), "logs"))
-        except (FileExistsError, OSError):
-            pass
-
         self.setLevel(self.level)
-        stream_handler = StreamHandler()
-        stream_handler.setLevel(self.level)
-        file_handler = FileHandler(
-            filename=os.path.join(os.path.realpath(os.path.dirname(__file__)), "logs",
-                                  "{log_time}.log".format(log_time=strftime("%Y-%m-%d", localtime()))),
-            mode="a",
-            encoding="utf-8",
-        )
-        file_handler.setLevel(DEBUG)
-        formatter = Formatter(fmt="%(asctime)s - [%(levelname)s] %(message)s")
-        stream_handler.setFormatter(formatter)
-        file_handler.setFormatter(formatter)
         self.handlers.clear()
-        self.addHandler(stream_handler)
-        self.addHandler(file_handler)
+        self.addHandler(_Backend.get_handler())
         return
 
     def get_logger(self) -> DefaultLogger:
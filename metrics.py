@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+import asyncio
+import bisect
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict, Iterable, Optional, Tuple
+
+from logger import Logger
+
+# 模块级别名在导入时求值, 用 typing 以兼容 Python 3.8
+Sample = Tuple[str, Dict[str, str], float]
+
+
+class _Cells:
+    """One list of numbers per thread, summed when scraped
+    Writers only touch their own list, so updates take no lock
+    """
+
+    def __init__(self, size: int) -> None:
+        self.size = size
+        self._local = threading.local()
+        self._cells: list[list[float]] = []
+        self._lock = threading.Lock()
+
+    def cell(self) -> list[float]:
+        try:
+            return self._local.cell
+        except AttributeError:
+            cell = self._local.cell = [0] * self.size
+            with self._lock:
+                self._cells.append(cell)
+            return cell
+
+    def total(self) -> list[float]:
+        with self._lock:
+            cells = list(self._cells)
+        return [sum(values) for values in zip(*cells)] if cells else [0] * self.size
+
+
+class Metric:
+    TYPE: str = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = labelnames
+        self._children: dict[tuple[str, ...], Metric] = {}
+        self._lock = threading.Lock()
+
+    def labels(self, *values) -> Metric:
+        key = tuple(str(v) for v in values)
+        try:
+            return self._children[key]
+        except KeyError:
+            with self._lock:
+                return self._children.setdefault(key, self._child())
+
+    def _child(self) -> Metric:
+        return type(self)(self.name, self.documentation)
+
+    def collect(self) -> Iterable[Sample]:
+        if not self.labelnames:
+            yield from self._samples({})
+            return
+        for values, child in list(self._children.items()):
+            yield from child._samples(dict(zip(self.labelnames, values)))
+
+    def _samples(self, labels: dict[str, str]) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    TYPE = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._cells = _Cells(1)
+
+    def inc(self, amount: float = 1) -> None:
+        self._cells.cell()[0] += amount
+
+    def _samples(self, labels: dict[str, str]) -> Iterable[Sample]:
+        yield self.name, labels, self._cells.total()[0]
+
+
+class Gauge(Metric):
+    TYPE = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.value: float = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def _samples(self, labels: dict[str, str]) -> Iterable[Sample]:
+        yield self.name, labels, self.value
+
+
+class Histogram(Metric):
+    TYPE = "histogram"
+    BUCKETS: tuple[float, ...] = (.005, .01, .025, .05, .1, .25, .5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                 buckets: tuple[float, ...] = BUCKETS) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = buckets
+        # 各区间计数, 最后两格为总和与总数
+        self._cells = _Cells(len(buckets) + 3)
+
+    def _child(self) -> Metric:
+        return Histogram(self.name, self.documentation, buckets=self.buckets)
+
+    def observe(self, value: float) -> None:
+        cell = self._cells.cell()
+        cell[bisect.bisect_left(self.buckets, value)] += 1
+        cell[-2] += value
+        cell[-1] += 1
+
+    def _samples(self, labels: dict[str, str]) -> Iterable[Sample]:
+        total = self._cells.total()
+        count = 0
+        for bound, n in zip(self.buckets + (float("inf"),), total):
+            count += n
+            yield self.name + "_bucket", dict(labels, le="+Inf" if bound == float("inf") else repr(bound)), count
+        yield self.name + "_sum", labels, total[-2]
+        yield self.name + "_count", labels, total[-1]
+
+
+class Collector(Metric):
+    """Values read from the running objects when scraped, costs nothing in between
+    func returns {label values: value}, or a bare number without labels
+    """
+
+    def __init__(self, name: str, documentation: str, func: Callable[[], object],
+                 labelnames: tuple[str, ...] = (), kind: str = "gauge") -> None:
+        super().__init__(name, documentation, labelnames)
+        self.func = func
+        self.TYPE = kind
+
+    def collect(self) -> Iterable[Sample]:
+        values = self.func()
+        if not self.labelnames:
+            yield self.name, {}, values
+            return
+        for key, value in values.items():
+            key = key if isinstance(key, tuple) else (key,)
+            yield self.name, dict(zip(self.labelnames, map(str, key))), value
+
+
+class Registry:
+    def __init__(self) -> None:
+        self._metrics: dict[str, Metric] = {}
+        self._lock = threading.Lock()
+        # 额外的只读页面, path -> () -> (content type, body)
+        self.routes: dict[str, Callable[[], tuple[str, bytes]]] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: tuple[str, ...] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: tuple[str, ...] = (),
+                  buckets: tuple[float, ...] = Histogram.BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def collector(self, name: str, documentation: str, func: Callable[[], object],
+                  labelnames: tuple[str, ...] = (), kind: str = "gauge") -> Collector:
+        return self.register(Collector(name, documentation, func, labelnames, kind))
+
+    def render(self) -> str:
+        """Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            metrics = list(self._metrics.values())
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.TYPE}")
+            for name, labels, value in metric.collect():
+                if labels:
+                    label_text = ",".join(f'{k}="{_escape(v)}"' for k, v in labels.items())
+                    lines.append(f"{name}{{{label_text}}} {_number(value)}")
+                else:
+                    lines.append(f"{name} {_number(value)}")
+        return "\n".join(lines) + "\n"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"')
+
+
+def _number(value: float) -> str:
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+REGISTRY = Registry()
+
+JOBS_RECEIVED = REGISTRY.counter("dd_jobs_received_total", "Jobs received from the cluster")
+JOBS_COMPLETED = REGISTRY.counter("dd_jobs_completed_total", "Jobs fetched and answered")
+JOBS_FAILED = REGISTRY.counter("dd_jobs_failed_total", "Jobs that failed to fetch")
+FETCH_SECONDS = REGISTRY.histogram("dd_fetch_seconds", "Latency of job fetches")
+CACHE_HITS = REGISTRY.counter("dd_cache_hits_total", "Jobs answered from the response cache")
+FETCH_COALESCED = REGISTRY.counter("dd_fetch_coalesced_total", "Jobs that shared an identical in-flight fetch")
+CLUSTER_SENT = REGISTRY.counter("dd_cluster_sent_total", "Frames sent to the cluster")
+CLUSTER_RECEIVED = REGISTRY.counter("dd_cluster_received_total", "Frames received from the cluster")
+IDENTITIES_RETIRED = REGISTRY.counter("dd_identities_retired_total", "buvid3 identities retired after being flagged")
+RECONNECTS = REGISTRY.counter("dd_reconnects_total", "Websocket reconnects", ("target",))
+LOOP_LAG = REGISTRY.gauge("dd_event_loop_lag_seconds", "How late a periodic timer fired on each event loop",
+                          ("loop",))
+
+
+async def watch_loop_lag(name: str, interval: float = 1.0) -> None:
+    """Measure the lag of the running event loop until cancelled"""
+    gauge = LOOP_LAG.labels(name)
+    while True:
+        start = time.monotonic()
+        await asyncio.sleep(interval)
+        gauge.set(max(time.monotonic() - start - interval, 0.0))
+
+
+class MetricsServer(threading.Thread):
+    """Serve REGISTRY at http://127.0.0.1:port/metrics"""
+    logger = Logger(logger_name="metrics")
+
+    def __init__(self, port: int, registry: Registry = REGISTRY) -> None:
+        super().__init__(name="MetricsServer", daemon=True)
+        self.port = port
+        self.registry = registry
+        self.server: Optional[ThreadingHTTPServer] = None
+
+    def run(self) -> None:
+        registry = self.registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                path = self.path.split("?")[0]
+                if path in registry.routes:
+                    content_type, body = registry.routes[path]()
+                elif path in ("/", "/metrics"):
+                    content_type = "text/plain; version=0.0.4; charset=utf-8"
+                    body = registry.render().encode("utf-8")
+                else:
+                    self.send_error(404)
+                    return
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args) -> None:
+                pass
+
+        try:
+            self.server = ThreadingHTTPServer(("127.0.0.1", self.port), Handler)
+        except OSError as e:
+            self.logger.error(f"Metrics endpoint on port {self.port} failed: {e}")
+            return
+        self.server.daemon_threads = True
+        self.logger.info(f"Metrics at http://127.0.0.1:{self.port}/metrics")
+        self.server.serve_forever()
+
+    def close(self) -> None:
+        if self.server is not None:
+            self.server.shutdown()
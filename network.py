@@ -0,0 +1,63 @@
+from __future__ import annotations
+
+import ipaddress
+from dataclasses import dataclass
+from random import randrange
+from socket import AF_INET, AF_INET6
+from typing import Optional
+
+from aiohttp import TCPConnector
+
+
+def random_address(prefix: str) -> str:
+    """A random host address inside an IPv6 prefix such as 2001:db8::/64"""
+    net = ipaddress.ip_network(prefix, strict=False)
+    return str(net.network_address + randrange(1, net.num_addresses))
+
+
+@dataclass(frozen=True)
+class NetworkOptions:
+    """Connection pool settings of the [Network] section
+    sources are local addresses or IPv6 prefixes to bind outgoing
+    connections to, every prefix is expanded to prefix_addresses
+    random addresses inside it
+    """
+    limit_per_host: int = 0
+    keepalive_timeout: float = 15.0
+    dns_ttl: int = 10
+    happy_eyeballs_delay: float = 0.25
+    sources: tuple[str, ...] = ()
+    prefix_addresses: int = 4
+
+    @classmethod
+    def from_config(cls, config) -> NetworkOptions:
+        return cls(config.limit_per_host, config.keepalive_timeout, config.dns_ttl, config.happy_eyeballs_delay,
+                   config.source_addresses, config.prefix_addresses)
+
+    def addresses(self, family: int) -> list[Optional[str]]:
+        """Local addresses to open one session each on, [None] for the default route
+        Addresses of the other family are skipped when family is fixed
+        """
+        result = []
+        for source in self.sources:
+            if "/" in source:
+                result += [random_address(source) for _ in range(self.prefix_addresses)]
+            else:
+                result.append(source)
+        result = [address for address in result
+                  if family == 0 or family == (AF_INET6 if ":" in address else AF_INET)]
+        return result or [None]
+
+    def connector(self, family: int, address: Optional[str] = None) -> TCPConnector:
+        if address is not None:
+            # 绑定源地址时只能连接同协议的目标
+            family = AF_INET6 if ":" in address else AF_INET
+        return TCPConnector(
+            family=family,
+            limit_per_host=self.limit_per_host,
+            keepalive_timeout=self.keepalive_timeout,
+            ttl_dns_cache=self.dns_ttl or None,
+            use_dns_cache=self.dns_ttl > 0,
+            happy_eyeballs_delay=self.happy_eyeballs_delay or None,
+            local_addr=(address, 0) if address is not None else None,
+        )
@@ -0,0 +1,121 @@
+from __future__ import annotations
+
+import threading
+import time
+from collections import deque
+
+
+class PullController:
+    """Decide when to pull another job from the cluster
+    Adaptive mode keeps an AIMD window of outstanding jobs (pulls waiting for
+    a reply + task backlog + in-flight fetches) and paces pulls by the
+    observed fetch latency, backing off while the cluster has no job.
+    Fixed mode pulls every interval while the backlog is below max_size.
+    """
+    MIN_DELAY: float = 0.05
+    MAX_DELAY: float = 10.0
+    MAX_BACKOFF: int = 64
+    # 拉取请求超过该时间未收到回复则视为丢失
+    PULL_TIMEOUT: float = 10.0
+    ALPHA: float = 0.2
+
+    def __init__(self, interval: float, max_size: int, max_inflight: int, adaptive: bool = True) -> None:
+        self.INTERVAL = interval
+        self.MAX_SIZE = max_size
+        self.adaptive = adaptive
+        self.max_window: int = max_inflight + max_size
+        self.window: float = float(max_inflight)
+        self.latency: float = interval
+        self.empty_rate: float = 0.0
+        self.failure_rate: float = 0.0
+        self._backoff: int = 1
+        # 限速器暂时无法处理新任务, 在此之前不再拉取
+        self._hold_until: float = 0.0
+        self._pulls: deque[float] = deque()
+        self._lock = threading.Lock()
+
+    def update(self, interval: float, max_size: int, max_inflight: int) -> None:
+        """Apply reloaded settings, the learned window is kept"""
+        with self._lock:
+            self.INTERVAL = interval
+            self.MAX_SIZE = max_size
+            self.max_window = max_inflight + max_size
+            self.window = min(self.window, float(self.max_window))
+
+    def reset(self) -> None:
+        """Forget pulls sent on a previous connection"""
+        with self._lock:
+            self._pulls.clear()
+            self._backoff = 1
+
+    def _expire(self, now: float) -> None:
+        pulls = self._pulls
+        while pulls and now - pulls[0] > self.PULL_TIMEOUT:
+            pulls.popleft()
+
+    @property
+    def outstanding(self) -> int:
+        return len(self._pulls)
+
+    def should_pull(self, backlog: int, inflight: int) -> int:
+        """Number of pulls to send now
+        Adaptive mode fills the whole credit shortfall of the window, but
+        sends one pull at a time while backing off an empty cluster
+        """
+        if not self.adaptive:
+            return 1 if backlog + inflight < self.MAX_SIZE else 0
+        now = time.monotonic()
+        if now < self._hold_until:
+            return 0
+        with self._lock:
+            self._expire(now)
+            shortfall = int(self.window) - len(self._pulls) - backlog - inflight
+            if self._backoff > 1:
+                return min(shortfall, 1) if shortfall > 0 else 0
+            return max(shortfall, 0)
+
+    def on_pull(self) -> None:
+        with self._lock:
+            self._pulls.append(time.monotonic())
+
+    def on_reply(self, empty: bool) -> None:
+        """The cluster answered a pull, with a job or with "empty" """
+        with self._lock:
+            if self._pulls:
+                self._pulls.popleft()
+            self.empty_rate += self.ALPHA * ((1.0 if empty else 0.0) - self.empty_rate)
+            if empty:
+                self._backoff = min(self._backoff * 2, self.MAX_BACKOFF)
+            else:
+                self._backoff = 1
+
+    def on_done(self, latency: float, ok: bool) -> None:
+        """A fetch finished, additive increase on success, halve on failure"""
+        with self._lock:
+            self.failure_rate += self.ALPHA * ((0.0 if ok else 1.0) - self.failure_rate)
+            if ok:
+                self.latency += self.ALPHA * (latency - self.latency)
+                self.window = min(self.window + 1.0 / self.window, float(self.max_window))
+            else:
+                self.window = max(self.window / 2.0, 1.0)
+
+    def on_limited(self, wait: float) -> None:
+        """A job was dropped by the rate limiter, hold pulls for wait seconds
+        so the node stops taking jobs it cannot serve
+        """
+        if wait <= 0:
+            return
+        with self._lock:
+            self._hold_until = max(self._hold_until, time.monotonic() + min(wait, self.MAX_DELAY))
+
+    @property
+    def delay(self) -> float:
+        if not self.adaptive:
+            return self.INTERVAL
+        delay = max(self.latency / self.window, self.MIN_DELAY) * self._backoff
+        return min(delay, self.MAX_DELAY)
+
+    def stats(self) -> str:
+        return (f"WINDOW: {self.window:.1f} | DELAY: {self.delay * 1000:.0f}ms | "
+                f"LATENCY: {self.latency * 1000:.0f}ms | EMPTY: {self.empty_rate:.0%} | "
+                f"FAIL: {self.failure_rate:.0%}")
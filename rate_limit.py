@@ -0,0 +1,159 @@
+from __future__ import annotations
+
+import asyncio
+import re
+import threading
+import time
+from random import uniform
+from typing import Optional, Union
+from urllib.parse import urlsplit
+
+
+class TokenBucket:
+    """Token bucket refilled at rate tokens per second, up to capacity
+    Thread-safe, callers decide whether to sleep or skip
+    """
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self._tokens = capacity
+        self._time = time.monotonic()
+        self._lock = threading.Lock()
+
+    def set_rate(self, rate: float) -> None:
+        with self._lock:
+            self._refill(time.monotonic())
+            self.rate = rate
+
+    def _refill(self, now: float) -> None:
+        self._tokens = min(self.capacity, self._tokens + (now - self._time) * self.rate)
+        self._time = now
+
+    def take(self, count: int = 1) -> int:
+        """Take up to count whole tokens, return how many were taken"""
+        with self._lock:
+            self._refill(time.monotonic())
+            taken = min(count, int(self._tokens))
+            if taken > 0:
+                self._tokens -= taken
+            return max(taken, 0)
+
+    def wait_time(self, count: int = 1) -> float:
+        """Seconds until count tokens are available"""
+        with self._lock:
+            self._refill(time.monotonic())
+            missing = count - self._tokens
+            return max(missing / self.rate, 0.0) if self.rate > 0 else float("inf")
+
+
+class RateLimited(Exception):
+    """The host can not be requested within the allowed wait"""
+
+    def __init__(self, host: str, wait: float) -> None:
+        super().__init__(f"{host} limited for {wait:.1f}s")
+        self.host = host
+        self.wait = wait
+
+
+class _Host:
+    def __init__(self, rate: float) -> None:
+        self.bucket = TokenBucket(rate, capacity=max(rate, 1.0))
+        self.blocked_until = 0.0
+        self.strikes = 0
+
+
+class HostLimiter:
+    """Token bucket per upstream host, shared by every thread and event loop
+    Risk-control responses (HTTP 412, code -352/-412) block the host for a
+    cooldown that doubles with each strike, with jitter, and halve its rate
+    The rate then grows back on successful responses
+    """
+    RISK_STATUS: tuple[int, ...] = (412,)
+    _RISK_BODY = re.compile(rb'"code"\s*:\s*-(?:352|412)\b')
+    MIN_RATE: float = 0.2
+    MAX_COOLDOWN: float = 1800.0
+    # 每次成功请求恢复的速率, 占设定速率的比例
+    RECOVERY: float = 0.05
+
+    def __init__(self, rate: float, cooldown: float = 60.0) -> None:
+        self.rate = rate
+        self.cooldown = cooldown
+        self._hosts: dict[str, _Host] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def host(url: str) -> str:
+        return urlsplit(url).hostname or ""
+
+    def _get(self, host: str) -> _Host:
+        state = self._hosts.get(host)
+        if state is None:
+            state = self._hosts[host] = _Host(self.rate)
+        return state
+
+    def reserve(self, host: str) -> float:
+        """Take a token for host, return 0 or the seconds to wait before retrying"""
+        now = time.monotonic()
+        with self._lock:
+            state = self._get(host)
+        if now < state.blocked_until:
+            return state.blocked_until - now
+        if self.rate <= 0 or state.bucket.take(1):
+            return 0.0
+        return state.bucket.wait_time(1)
+
+    async def acquire(self, url: str, max_wait: float, source: Optional[str] = None) -> str:
+        """Wait for the host of url to allow one more request, return the host
+        Requests from different source addresses are limited separately
+        Raise RateLimited instead of waiting longer than max_wait
+        """
+        host = self.host(url) if source is None else f"{self.host(url)}@{source}"
+        while (wait := self.reserve(host)) > 0:
+            if wait > max_wait:
+                raise RateLimited(host, wait)
+            max_wait -= wait
+            await asyncio.sleep(wait)
+        return host
+
+    def is_risky(self, status: int, body: Union[bytes, bytearray, memoryview] = b"") -> bool:
+        # 风控页面的 code 在 json 开头, 只看前面一小段
+        return status in self.RISK_STATUS or self._RISK_BODY.search(body[:64]) is not None
+
+    def on_response(self, host: str, risky: bool) -> Optional[float]:
+        """Feed back one response, return the cooldown if the host is now blocked"""
+        with self._lock:
+            state = self._get(host)
+            bucket = state.bucket
+            now = time.monotonic()
+            if not risky:
+                if not state.strikes:
+                    return None
+                if self.rate > 0:
+                    bucket.set_rate(min(bucket.rate + self.rate * self.RECOVERY, self.rate))
+                    if bucket.rate >= self.rate:
+                        state.strikes = 0
+                elif now - state.blocked_until > self.cooldown:
+                    state.strikes = 0
+                return None
+            if now < state.blocked_until:
+                # 冷却前发出的请求陆续返回, 不重复计数
+                return None
+            state.strikes += 1
+            cooldown = min(self.cooldown * 2 ** (state.strikes - 1), self.MAX_COOLDOWN) * uniform(0.8, 1.2)
+            state.blocked_until = now + cooldown
+            if self.rate > 0:
+                bucket.set_rate(max(bucket.rate / 2, self.MIN_RATE))
+            return cooldown
+
+    def stats(self) -> dict[str, dict[str, float]]:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                host: {
+                    "rate": state.bucket.rate,
+                    "strikes": state.strikes,
+                    "blocked": max(state.blocked_until - now, 0.0),
+                }
+                for host, state in self._hosts.items()
+            }
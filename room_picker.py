@@ -0,0 +1,61 @@
+from __future__ import annotations
+
+import threading
+import time
+from random import random
+
+import codec
+from rate_limit import TokenBucket
+
+
+class RoomPicker:
+    """Keep several pickRoom queries outstanding while relay slots are free
+    Queries are throttled by the connect rate and by the number of rooms
+    still connecting, replies are matched to queries by their key
+    """
+    # 超过该时间未收到回复的查询视为丢失
+    QUERY_TIMEOUT: float = 30.0
+    MAX_DELAY: float = 5.0
+
+    def __init__(self, connect_rate: float, max_connecting: int) -> None:
+        self.CONNECT_RATE = connect_rate
+        self.MAX_CONNECTING = max_connecting
+        self.bucket = TokenBucket(rate=connect_rate, capacity=max(connect_rate, 1.0))
+        self._pending: dict[str, float] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def pending(self) -> int:
+        return len(self._pending)
+
+    def reset(self) -> None:
+        """Forget queries sent on a previous connection"""
+        with self._lock:
+            self._pending.clear()
+
+    def _expire(self, now: float) -> None:
+        expired = [key for key, sent in self._pending.items() if now - sent > self.QUERY_TIMEOUT]
+        [self._pending.pop(key) for key in expired]
+
+    def queries(self, free: int, connecting: int) -> list[bytes]:
+        """Build as many pickRoom queries as the free slots allow right now"""
+        now = time.monotonic()
+        with self._lock:
+            self._expire(now)
+            want = min(free - len(self._pending), self.MAX_CONNECTING - connecting - len(self._pending))
+            count = self.bucket.take(want) if want > 0 else 0
+            keys = [str(random()) for _ in range(count)]
+            for key in keys:
+                self._pending[key] = now
+        return [codec.dumps({"key": key, "query": {"type": "pickRoom"}}) for key in keys]
+
+    def on_reply(self, key: str) -> bool:
+        """Return True if the reply answers one of our queries"""
+        with self._lock:
+            return self._pending.pop(key, None) is not None
+
+    def delay(self, free: int) -> float:
+        """How long to wait before trying to send more queries"""
+        if free <= len(self._pending):
+            return self.MAX_DELAY
+        return min(max(self.bucket.wait_time(), 0.05), self.MAX_DELAY)
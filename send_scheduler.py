@@ -0,0 +1,205 @@
+from __future__ import annotations
+
+import asyncio
+import threading
+import time
+from collections import deque
+from queue import Empty
+from typing import Any, Optional
+
+# 消息类别, 数字越小优先级越高
+JOB = 0
+CONTROL = 1
+RELAY = 2
+CLASS_NAMES: tuple[str, ...] = ("job", "control", "relay")
+
+# 队列满时的处理方式: 阻塞生产者/丢弃最旧的消息/丢弃新消息
+BLOCK = "block"
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+POLICIES: tuple[str, ...] = (BLOCK, DROP_OLDEST, DROP_NEWEST)
+
+
+class SendScheduler:
+    """Multi-class outbound queue for the cluster websockets
+    Producers put (class, payload) tuples, FIFO inside each class
+    Classes are served by weighted round robin, or strictly by class order
+    Each class has a capacity and a policy for when it is full
+    """
+    _queues: list[deque]
+    _waiters: list[tuple[asyncio.AbstractEventLoop, asyncio.Future]]
+    _space_waiters: list[list[tuple[asyncio.AbstractEventLoop, asyncio.Future]]]
+
+    def __init__(self,
+                 weights: tuple[int, ...] = (8, 4, 1),
+                 strict: bool = False,
+                 capacities: tuple[int, ...] = (1000, 100, 10000),
+                 policies: tuple[str, ...] = (BLOCK, DROP_NEWEST, BLOCK)) -> None:
+        assert len(weights) == len(CLASS_NAMES) and all(w > 0 for w in weights)
+        assert len(capacities) == len(CLASS_NAMES) and all(c > 0 for c in capacities)
+        assert len(policies) == len(CLASS_NAMES) and all(p in POLICIES for p in policies)
+        self.weights = tuple(weights)
+        self.strict = strict
+        self.capacities = tuple(capacities)
+        self.policies = tuple(policies)
+        self._queues = [deque() for _ in CLASS_NAMES]
+        self._credits = list(self.weights)
+        self._lock = threading.Lock()
+        self._not_empty = threading.Condition(self._lock)
+        self._not_full = [threading.Condition(self._lock) for _ in CLASS_NAMES]
+        self._waiters = []
+        self._space_waiters = [[] for _ in CLASS_NAMES]
+        self.drops = [0 for _ in CLASS_NAMES]
+        # 每个类别的 [出队数, 总等待时间, 最长等待时间] (纳秒)
+        self._waits = [[0, 0, 0] for _ in CLASS_NAMES]
+
+    def put(self, item: tuple[int, Any], block: bool = True, timeout: Optional[float] = None) -> bool:
+        """Queue a message, return False if it was dropped
+        Blocking classes wait for space unless block is False, then the
+        new message is dropped instead
+        """
+        cls, payload = item[0], item[1]
+        tag = item[2] if len(item) > 2 else None
+        with self._lock:
+            queue = self._queues[cls]
+            if len(queue) >= self.capacities[cls]:
+                policy = self.policies[cls]
+                if policy == BLOCK and block:
+                    self._not_full[cls].wait_for(lambda: len(queue) < self.capacities[cls], timeout=timeout)
+                if len(queue) >= self.capacities[cls]:
+                    self.drops[cls] += 1
+                    if policy != DROP_OLDEST:
+                        return False
+                    queue.popleft()
+            queue.append((time.monotonic_ns(), payload, tag))
+            self._not_empty.notify()
+            waiters, self._waiters = self._waiters, []
+        for loop, fut in waiters:
+            loop.call_soon_threadsafe(self._wake, fut)
+        return True
+
+    def put_nowait(self, item: tuple[int, Any]) -> bool:
+        return self.put(item, block=False)
+
+    async def put_async(self, item: tuple[int, Any]) -> bool:
+        """Queue a message from an event loop, waiting for space without blocking it"""
+        if self.policies[item[0]] == BLOCK:
+            await self.wait_space(item[0])
+        return self.put(item, block=False)
+
+    def full(self, cls: int) -> bool:
+        return len(self._queues[cls]) >= self.capacities[cls]
+
+    async def wait_space(self, cls: int) -> None:
+        """Wait until the class has room for another message
+        Danmaku readers call this before reading, so a full relay queue
+        stops them from reading their sockets
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                if len(self._queues[cls]) < self.capacities[cls]:
+                    return
+                fut = loop.create_future()
+                self._space_waiters[cls].append((loop, fut))
+            try:
+                await fut
+            finally:
+                with self._lock:
+                    if (loop, fut) in self._space_waiters[cls]:
+                        self._space_waiters[cls].remove((loop, fut))
+
+    @staticmethod
+    def _wake(fut: asyncio.Future) -> None:
+        if not fut.done():
+            fut.set_result(None)
+
+    def _pick(self) -> Optional[int]:
+        queues = self._queues
+        if self.strict:
+            for cls, queue in enumerate(queues):
+                if queue:
+                    return cls
+            return None
+        for _ in range(2):
+            for cls, queue in enumerate(queues):
+                if queue and self._credits[cls] > 0:
+                    self._credits[cls] -= 1
+                    return cls
+            # 所有非空类别的额度都用完了, 开始新一轮
+            self._credits = list(self.weights)
+        return None
+
+    def _pop(self) -> Optional[tuple[int, Any, Any]]:
+        cls = self._pick()
+        if cls is None:
+            return None
+        enqueued, payload, tag = self._queues[cls].popleft()
+        self._not_full[cls].notify()
+        if self._space_waiters[cls]:
+            waiters, self._space_waiters[cls] = self._space_waiters[cls], []
+            for loop, fut in waiters:
+                loop.call_soon_threadsafe(self._wake, fut)
+        waited = time.monotonic_ns() - enqueued
+        stat = self._waits[cls]
+        stat[0] += 1
+        stat[1] += waited
+        if waited > stat[2]:
+            stat[2] = waited
+        return cls, payload, tag
+
+    def get(self, block: bool = True, timeout: Optional[float] = None) -> tuple[int, Any, Any]:
+        """Return (class, payload, tag), tag is the optional third item given to put"""
+        with self._not_empty:
+            item = self._pop()
+            if item is None and block:
+                self._not_empty.wait_for(lambda: any(self._queues), timeout=timeout)
+                item = self._pop()
+            if item is None:
+                raise Empty
+            return item
+
+    def get_nowait(self) -> tuple[int, Any, Any]:
+        return self.get(block=False)
+
+    async def get_async(self) -> tuple[int, Any, Any]:
+        """Wait for the next message without blocking the event loop"""
+        loop = asyncio.get_running_loop()
+        while True:
+            with self._lock:
+                item = self._pop()
+                if item is not None:
+                    return item
+                fut = loop.create_future()
+                self._waiters.append((loop, fut))
+            try:
+                await fut
+            finally:
+                with self._lock:
+                    if (loop, fut) in self._waiters:
+                        self._waiters.remove((loop, fut))
+
+    def qsize(self, cls: Optional[int] = None) -> int:
+        if cls is None:
+            return sum(len(queue) for queue in self._queues)
+        return len(self._queues[cls])
+
+    def empty(self) -> bool:
+        return not any(self._queues)
+
+    def stats(self, reset: bool = True) -> dict[str, dict[str, float]]:
+        """Queue depth and wait time of each class since the last reset"""
+        with self._lock:
+            result = {
+                name: {
+                    "depth": len(self._queues[cls]),
+                    "dropped": self.drops[cls],
+                    "sent": self._waits[cls][0],
+                    "avg_wait_ms": self._waits[cls][1] / self._waits[cls][0] / 1e6 if self._waits[cls][0] else 0.0,
+                    "max_wait_ms": self._waits[cls][2] / 1e6,
+                }
+                for cls, name in enumerate(CLASS_NAMES)
+            }
+            if reset:
+                self._waits = [[0, 0, 0] for _ in CLASS_NAMES]
+        return result
@@ -0,0 +1,134 @@
+from __future__ import annotations
+
+import atexit
+import json
+import threading
+import time
+from collections import deque
+from queue import SimpleQueue
+from typing import Optional
+
+
+class JobTrace:
+    """Nanosecond timestamps of one job, 0 for stages it never reached"""
+    __slots__ = ("key", "received", "dequeued", "fetch_start", "fetch_end", "queued", "sent", "ok")
+    STAGES = ("received", "dequeued", "fetch_start", "fetch_end", "queued", "sent")
+
+    def __init__(self, key: str, received: int) -> None:
+        self.key = key
+        self.received = received
+        self.dequeued = self.fetch_start = self.fetch_end = self.queued = self.sent = 0
+        self.ok = False
+
+    def to_dict(self) -> dict:
+        return {"key": self.key, "ok": self.ok, **{stage: getattr(self, stage) for stage in self.STAGES}}
+
+    @property
+    def queue_wait(self) -> int:
+        return self.dequeued - self.received
+
+    @property
+    def network(self) -> int:
+        return self.fetch_end - self.fetch_start
+
+    @property
+    def send_wait(self) -> int:
+        return self.sent - self.queued
+
+
+class Tracer:
+    """Keep the last size job traces in a ring buffer
+    Finished traces are also appended to path as json lines when it is set,
+    they go through a queue and are written by one background thread
+    """
+    SPANS = ("queue_wait", "network", "send_wait")
+
+    def __init__(self, size: int, path: str = "") -> None:
+        self.enabled = size > 0
+        self.traces: deque[JobTrace] = deque(maxlen=max(size, 1))
+        self.path = path
+        self._lock = threading.Lock()
+        self._queue: SimpleQueue[Optional[JobTrace]] = SimpleQueue()
+        self._writer: Optional[threading.Thread] = None
+        if path:
+            atexit.register(self.close)
+
+    def start(self, key: str, received: int) -> Optional[JobTrace]:
+        """Begin a trace when the job is taken off the task queue"""
+        if not self.enabled:
+            return None
+        trace = JobTrace(key, received)
+        trace.dequeued = time.time_ns()
+        return trace
+
+    def finish(self, trace: Optional[JobTrace], ok: bool = True) -> None:
+        if trace is None:
+            return
+        trace.ok = ok
+        self.traces.append(trace)
+        if self.path:
+            if self._writer is None:
+                self._start_writer()
+            self._queue.put(trace)
+
+    def _start_writer(self) -> None:
+        with self._lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write, name="Tracer", daemon=True)
+                self._writer.start()
+
+    def _write(self) -> None:
+        """Drain the queue into path, one flush per batch, until None is queued"""
+        with open(self.path, "a", encoding="utf-8") as f:
+            while True:
+                traces = [self._queue.get()]
+                while not self._queue.empty():
+                    traces.append(self._queue.get())
+                stop = None in traces
+                f.writelines(json.dumps(t.to_dict(), separators=(",", ":")) + "\n"
+                             for t in traces if t is not None)
+                f.flush()
+                if stop:
+                    return
+
+    def dump(self, path: Optional[str] = None) -> bytes:
+        """The ring buffer as json lines, also written to path if given"""
+        data = "".join(json.dumps(t.to_dict(), separators=(",", ":")) + "\n" for t in list(self.traces))
+        if path:
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(data)
+        return data.encode("utf-8")
+
+    def summary(self) -> dict[str, dict[str, float]]:
+        """Milliseconds spent waiting in the task queue, on the network and before the socket send"""
+        traces = [t for t in list(self.traces) if t.ok and t.sent]
+        result = {}
+        for span in self.SPANS + ("total",):
+            values = sorted(
+                (getattr(t, span) if span != "total" else t.sent - t.received) / 1e6 for t in traces
+            )
+            if not values:
+                continue
+            result[span] = {
+                "avg": sum(values) / len(values),
+                "p50": values[len(values) // 2],
+                "p90": values[min(int(len(values) * .9), len(values) - 1)],
+            }
+        return result
+
+    def format_summary(self) -> str:
+        summary = self.summary()
+        if not summary:
+            return "TRACE: no finished jobs"
+        return "TRACE: " + " | ".join(
+            f"{span.upper()}: avg {s['avg']:.1f} p50 {s['p50']:.1f} p90 {s['p90']:.1f}ms"
+            for span, s in summary.items()
+        )
+
+    def close(self) -> None:
+        """Write the queued traces and stop the writer, the next finish starts a new one"""
+        with self._lock:
+            writer, self._writer = self._writer, None
+            if writer is not None:
+                self._queue.put(None)
+                writer.join()
@@ -0,0 +1,111 @@
+from __future__ import annotations
+
+import asyncio
+import hashlib
+import time
+from functools import lru_cache
+from operator import itemgetter
+from typing import Callable, Optional
+from urllib.parse import parse_qsl, urlencode
+
+from aiohttp import ClientSession
+from async_timeout import timeout
+
+import codec
+from logger import Logger
+from rate_limit import HostLimiter, RateLimited
+
+# img_key + sub_key 按此顺序重排后取前32位
+MIXIN_KEY_ENC_TAB: tuple[int, ...] = (
+    46, 47, 18, 2, 53, 8, 23, 32, 15, 50, 10, 31, 58, 3, 45, 35, 27, 43, 5, 49, 33, 9, 42, 19, 29, 28, 14, 39,
+    12, 38, 41, 13, 37, 48, 7, 16, 24, 55, 40, 61, 26, 17, 0, 1, 60, 51, 30, 4, 22, 25, 54, 21, 56, 59, 6, 63,
+    57, 62, 11, 36, 20, 34, 44, 52,
+)
+_PICK_MIXIN = itemgetter(*MIXIN_KEY_ENC_TAB[:32])
+_FILTERED = str.maketrans("", "", "!'()*")
+
+
+def get_mixin_key(img_key: str, sub_key: str) -> str:
+    return "".join(_PICK_MIXIN(img_key + sub_key))
+
+
+@lru_cache(maxsize=4096)
+def _prepare(query: str) -> tuple[str, str]:
+    """Sort and encode the parameters of one query string once
+    Return the encoded parts before and after the wts parameter
+    """
+    params = sorted((k, v.translate(_FILTERED)) for k, v in parse_qsl(query, keep_blank_values=True)
+                    if k not in ("w_rid", "wts"))
+    before = urlencode([(k, v) for k, v in params if k < "wts"])
+    after = urlencode([(k, v) for k, v in params if k > "wts"])
+    return before + "&" if before else "", "&" + after if after else ""
+
+
+class WbiSigner:
+    """Sign /wbi/ urls with the mixin key from the nav endpoint
+    The key is refreshed in the background, signing never waits for it
+    """
+    NAV_URL: str = "https://api.bilibili.com/x/web-interface/nav"
+    HEADERS: dict[str, str] = {
+        "referer": "https://www.bilibili.com/",
+        "user-agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/115.0.0.0 Safari/537.36",
+    }
+    REFRESH_INTERVAL: float = 600.0
+    RETRY_INTERVAL: float = 30.0
+    logger = Logger(logger_name="wbi")
+
+    def __init__(self, limiter: Optional[HostLimiter] = None, headers: Optional[dict[str, str]] = None) -> None:
+        self.limiter = limiter or HostLimiter(0)
+        self.headers = headers or self.HEADERS
+        self.mixin: str = ""
+        self.updated: float = 0.0
+
+    @staticmethod
+    def needs_sign(url: str) -> bool:
+        return "/wbi/" in url
+
+    def sign(self, url: str, now: Optional[float] = None) -> str:
+        """Return url with fresh wts and w_rid, unchanged until the first key is loaded"""
+        if not self.mixin:
+            return url
+        base, _, query = url.partition("?")
+        before, after = _prepare(query)
+        query = f"{before}wts={int(now or time.time())}{after}"
+        w_rid = hashlib.md5((query + self.mixin).encode("utf-8")).hexdigest()
+        return f"{base}?{query}&w_rid={w_rid}"
+
+    def update(self, img_url: str, sub_url: str) -> None:
+        img_key = img_url.rsplit("/", 1)[-1].split(".")[0]
+        sub_key = sub_url.rsplit("/", 1)[-1].split(".")[0]
+        self.mixin = get_mixin_key(img_key, sub_key)
+        self.updated = time.monotonic()
+        self.logger.debug(f"Update mixin key: {self.mixin}")
+
+    async def refresh(self, session: ClientSession, source: Optional[str] = None) -> None:
+        host = await self.limiter.acquire(self.NAV_URL, self.RETRY_INTERVAL, source)
+        async with timeout(10):
+            async with session.get(self.NAV_URL, headers=self.headers) as resp:
+                body = await resp.read()
+        risky = self.limiter.is_risky(resp.status, body)
+        self.limiter.on_response(host, risky)
+        if risky:
+            raise RateLimited(host, 0.0)
+        # 未登录时 code 为 -101, 但仍会返回 wbi_img
+        wbi_img = codec.loads(body)["data"]["wbi_img"]
+        self.update(wbi_img["img_url"], wbi_img["sub_url"])
+
+    async def keep_fresh(self, sessions: Callable[[], tuple[ClientSession, Optional[str]]]) -> None:
+        """Refresh the key every REFRESH_INTERVAL until cancelled
+        sessions returns a job session and its source address, so the
+        nav request follows the network settings of the jobs
+        """
+        while True:
+            age = time.monotonic() - self.updated
+            if self.mixin and age < self.REFRESH_INTERVAL:
+                await asyncio.sleep(self.REFRESH_INTERVAL - age)
+            try:
+                await self.refresh(*sessions())
+            except Exception as e:
+                # 任何错误都不能让刷新停止, 否则会一直使用过期的 key
+                self.logger.warning(f"Update wbi key failed: {type(e).__name__} {e}")
+                await asyncio.sleep(self.RETRY_INTERVAL)
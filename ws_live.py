@@ -1,88 +1,132 @@
 from __future__ import annotations
 
-import time
-from concurrent.futures import ThreadPoolExecutor
+import os
+import threading
 from threading import Thread
-from typing import Optional
+from typing import Callable, Optional
 
 from dm_manager import DManager
 from logger import Logger
 
 
 class WSLive(Thread):
+    """Schedule live rooms over a fixed pool of DManager event loops
+    New rooms go to the least loaded loop, and rooms are moved between
+    loops when the load drifts apart as rooms come and go
+    Room closes are pushed by the managers, listeners are told at once
+    that a slot is free
+    """
     started: bool
     logger: Logger
-    managers: set[DManager]
+    managers: list[DManager]
     rooms: int
     lived: set[int]
-    pool: ThreadPoolExecutor
     current_loop: Optional[DManager]
+    REBALANCE_INTERVAL: float = 30.0
+    # 最忙和最闲的事件循环负载相差超过平均负载的该比例时迁移直播间
+    IMBALANCE: float = 0.25
 
-    def __init__(self, ws_limit: int) -> None:
+    def __init__(self, ws_limit: int, loops: int = 0) -> None:
         super().__init__(name="WSLive", daemon=True)
         self.started = False
         self.logger = Logger(logger_name="bili-ws", level=Logger.INFO)
-        self.managers = set()
+        self.WS_LIMIT = ws_limit
+        self.LOOPS = loops if loops > 0 else (os.cpu_count() or 1)
+        self.managers = [DManager(index=index, on_close=self._on_room_closed) for index in range(self.LOOPS)]
         self.rooms = 0
         self.lived = set()
-        self.pool = ThreadPoolExecutor(max_workers=ws_limit)
         self.send_queue = None
         self.current_loop = None
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._dirty = False
+        self._listeners: list[Callable[[], None]] = []
 
     def set_queue(self, send_queue) -> None:
         self.send_queue = send_queue
-        [room.set_queue(send_queue) for room in self.managers]
+        [manager.set_queue(send_queue) for manager in self.managers]
+
+    def add_listener(self, listener: Callable[[], None]) -> None:
+        """Call listener from the manager thread whenever a room closes"""
+        self._listeners.append(listener)
+
+    def remove_listener(self, listener: Callable[[], None]) -> None:
+        if listener in self._listeners:
+            self._listeners.remove(listener)
+
+    def set_limit(self, ws_limit: int) -> None:
+        """Change the room limit at runtime, listeners are woken to fill new slots"""
+        self.WS_LIMIT = ws_limit
+        [listener() for listener in list(self._listeners)]
+
+    @property
+    def free(self) -> int:
+        return max(self.WS_LIMIT - self.rooms, 0)
+
+    @property
+    def connecting(self) -> int:
+        """Rooms opened but not connected to the danmaku server yet"""
+        return sum(manager.connecting for manager in self.managers)
 
     def startup(self) -> None:
+        [manager.start() for manager in self.managers]
         self.started = True
         while self.started:
-            self._clean_dead_rooms()
-            time.sleep(1)
-
-    def _clean_dead_rooms(self) -> None:
-        all_rooms = set()
-        [all_rooms.update(manager.get_rooms()) for manager in self.managers]
-        if diff := self.lived - all_rooms:
-            for dead_room in diff:
-                self.logger.debug(f"CLOSE: {dead_room}")
-                self.lived.remove(dead_room)
-            self.rooms -= len(diff)
-
-    def managers_available(self) -> bool:
-        avail = [manager.is_available() for manager in self.managers]
-        if avail:
-            return any(avail)
-        # no manager
-        return False
+            with self._changed:
+                self._changed.wait_for(lambda: self._dirty, timeout=self.REBALANCE_INTERVAL)
+                self._dirty = False
+            self.rebalance()
+
+    def _on_room_closed(self, room_id: int) -> None:
+        with self._changed:
+            if room_id not in self.lived:
+                return
+            self.lived.remove(room_id)
+            self.rooms -= 1
+            self._dirty = True
+            self._changed.notify()
+        self.logger.debug(f"CLOSE: {room_id}")
+        [listener() for listener in list(self._listeners)]
 
     def pick_avail_manager(self) -> DManager:
-        for manager in self.managers:
-            if manager.is_available():
-                return manager
+        return min(self.managers, key=lambda manager: manager.load)
 
-    def watch(self, room_id: int) -> None:
-        if not room_id or room_id in self.lived:
+    def rebalance(self) -> None:
+        """Move one room from the busiest loop to the idlest one
+        Pick the room that brings the two loads closest together
+        """
+        busiest = max(self.managers, key=lambda manager: manager.load)
+        idlest = min(self.managers, key=lambda manager: manager.load)
+        gap = busiest.load - idlest.load
+        mean = sum(manager.load for manager in self.managers) / len(self.managers)
+        if busiest is idlest or gap <= max(mean * self.IMBALANCE, DManager.SOCKET_COST * 2):
+            return
+        target = gap / 2
+        candidates = [(abs(rate + DManager.SOCKET_COST - target), room_id)
+                      for room_id, rate in busiest.room_rates().items()
+                      if rate + DManager.SOCKET_COST < gap]
+        if not candidates:
+            return
+        _, room_id = min(candidates)
+        if busiest.release(room_id) is None:
             return
-        is_new = False
-        if self.managers_available():
-            self.current_loop = self.pick_avail_manager()
-            self.logger.debug(f"Reuse manager: {self.current_loop.name}")
-        else:
-            self.current_loop = DManager(index=len(self.managers))
-            self.logger.debug(f"New manager: {self.current_loop.name}")
-            self.managers.add(self.current_loop)
-            is_new = True
-        self.rooms += 1
+        self.logger.debug(f"MOVE: {room_id} {busiest.name} -> {idlest.name}")
+        idlest.watch(room_id, self.send_queue)
+
+    def watch(self, room_id: int) -> None:
+        with self._lock:
+            if not room_id or room_id in self.lived:
+                return
+            self.rooms += 1
+            self.lived.add(room_id)
+        self.current_loop = self.pick_avail_manager()
+        self.logger.debug(f"Pick manager: {self.current_loop.name}")
         self.logger.debug(f"WATCH: {room_id}")
-        self.add(room_id, is_new)
+        self.add(room_id)
 
-    def add(self, room_id: int, is_new: bool) -> None:
-        if is_new:
-            self.pool.submit(self.current_loop.start)
-            self.logger.debug("New thread in pool")
+    def add(self, room_id: int) -> None:
         self.current_loop.watch(room_id, self.send_queue)
         self.logger.debug(f"OPEN: {room_id}")
-        self.lived.add(room_id)
 
     def run(self) -> None:
         try:
@@ -92,4 +136,6 @@ class WSLive(Thread):
 
     def ws_close(self) -> None:
         self.started = False
-        self.pool.shutdown(wait=False)
+        with self._changed:
+            self._dirty = True
+            self._changed.notify()